@@ -31,15 +31,38 @@ Options:
 When initializing a Compreffor object, options can be set using
 the options kwargs. They are:
     - verbose (boolean) -- print status messages during compression
-    - nrounds (integer) -- the number of market iterations to run
+    - nrounds (integer) -- the number of market iterations to run, or the
+                           most to run if convergence is given
+    - convergence (float) -- stop iterating once the market changes by less
+                             than this fraction between rounds
     - nsubrs_limit (integer) -- limit to number of subrs per INDEX
+    - max_subr_length (integer) -- limit to number of tokens in a candidate
+                                   subr
+With Methods.CxxExecutable and Methods.CxxLib, the following additional
+options are available (the Py backend ignores them, so that Methods.NoPref
+can fall back to it with the same options):
+    - threads (integer) -- the number of threads to run the market on
+    - suffix_sort (string) -- how to sort the suffixes of the charstrings,
+                              "sais" (default) or "compare"
 With Methods.Py, the following additional options are available:
     - print_status (boolean) -- printing level lower than verbose
-    - chunk_ratio (float) -- set the percentage of charstrings
-                             to be run by each process
+    - chunk_ratio (float) -- split each round's work into about
+                             1 / chunk_ratio chunks of equal estimated
+                             DP cost, handed out to the processes
     - single_process (boolean) -- disable multiprocessing
     - processes (integer) -- the number of simultaneous processes
                              to run
+    - max_candidates (integer) -- limit to number of candidate subrs
+                                  entering the market
+    - incremental (boolean) -- only re-optimize the charstrings a market
+                               round affects (defaults to True)
+    - price_epsilon (float) -- with incremental rounds, ignore candidate
+                               subr price moves this small or smaller
+                               (defaults to 0)
+    - finder (string or class) -- the engine that finds candidate subrs,
+                                  "suffix" (default) or "moveto"
+    - pool (MarketPool) -- worker processes to reuse across fonts, which
+                           the caller closes when done
 
 Compression Backends:
 There are 3 different ways the compreffor can be run.
@@ -89,6 +112,9 @@ class Methods:
     NoPref, Py, CxxExecutable, CxxLib = range(4)
 
 class Compreffor(object):
+    # options only the C++ backends take
+    CXX_OPTIONS = ("threads", "suffix_sort")
+
     def __init__(self, font, method=Methods.NoPref, **options):
         self.font = font
         self.method = method
@@ -115,7 +141,9 @@ class Compreffor(object):
             assert 0
 
     def run_py(self):
-        compreffor = pyCompressor.Compreffor(self.font, **self.options)
+        options = dict((k, v) for k, v in self.options.iteritems()
+                       if k not in self.CXX_OPTIONS)
+        compreffor = pyCompressor.Compreffor(self.font, **options)
         compreffor.compress()
 
     def run_executable(self):
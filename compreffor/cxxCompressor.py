@@ -47,7 +47,10 @@ from testPyCompressor import test_compression_integrity, test_call_depth
 
 # default values:
 NSUBRS_LIMIT = 65533
+NROUNDS = 4
 SUBR_NEST_LIMIT  = 10
+# in the order of suffix_sort_t in cffCompressor.h
+SUFFIX_SORTS = ['sais', 'compare']
 
 class IdKeyMap(object):
     """A map that where every key's value is itself. Used
@@ -206,9 +209,29 @@ def compreff(font, verbose=False, use_lib=False, **kwargs):
 
     call = [os.path.join(os.path.abspath(os.path.dirname(__file__)), "cffCompressor")]
 
+    if verbose:
+        call.append('--verbose')
+
     if 'nrounds' in kwargs and kwargs.get('nrounds') != None:
         call.extend(['--nrounds', str(kwargs.get('nrounds'))])
 
+    if 'convergence' in kwargs and kwargs.get('convergence') != None:
+        call.extend(['--convergence', str(kwargs.get('convergence'))])
+
+    if 'max_subr_length' in kwargs and kwargs.get('max_subr_length') != None:
+        call.extend(['--maxlength', str(kwargs.get('max_subr_length'))])
+
+    threads = kwargs.get('threads')
+    if threads != None:
+        assert threads >= 0, "Invalid thread count: %s" % threads
+        call.extend(['--threads', str(threads)])
+
+    suffix_sort = kwargs.get('suffix_sort')
+    if suffix_sort != None:
+        assert suffix_sort in SUFFIX_SORTS, \
+               "Unrecognized suffix sort: %s" % suffix_sort
+        call.extend(['--suffixsort', suffix_sort])
+
     max_subrs = NSUBRS_LIMIT
     if 'nsubrs_limit' in kwargs and kwargs.get('nsubrs_limit') != None:
         max_subrs = kwargs.get('nsubrs_limit')
@@ -217,11 +240,29 @@ def compreff(font, verbose=False, use_lib=False, **kwargs):
         lib_path = os.path.join(os.path.dirname(__file__), "libcompreff.so")
         libcompreff = ctypes.CDLL(lib_path)
         libcompreff.compreff.restype = ctypes.POINTER(ctypes.c_uint32)
+        libcompreff.compreff.argtypes = [ctypes.c_char_p, ctypes.c_int,
+                                         ctypes.c_float, ctypes.c_int,
+                                         ctypes.c_uint, ctypes.c_int]
         input_data = ctypes.c_char_p(write_data(td))
         if verbose:
             print("Produced data for C++ (delta %gs)" % (time.time() - start_time))
             start_time = time.time()
-        results = libcompreff.compreff(input_data, 4)
+        nrounds = kwargs.get('nrounds')
+        if nrounds == None:
+            nrounds = NROUNDS
+        convergence = kwargs.get('convergence')
+        if convergence == None:
+            convergence = 0
+        if threads == None:
+            threads = 0
+        max_subr_length = kwargs.get('max_subr_length')
+        if max_subr_length == None:
+            max_subr_length = 0
+        if suffix_sort == None:
+            suffix_sort = 'sais'
+        results = libcompreff.compreff(input_data, nrounds, convergence,
+                                       threads, max_subr_length,
+                                       SUFFIX_SORTS.index(suffix_sort))
         if verbose:
             print("Lib call returned (delta %gs)" % (time.time() - start_time))
             start_time = time.time()
@@ -236,6 +277,9 @@ def compreff(font, verbose=False, use_lib=False, **kwargs):
             print("Produced data for C++ (delta %gs)" % (time.time() - start_time))
             start_time = time.time()
         results, _ = p.communicate(input=input_data)
+        if p.returncode != 0:
+            raise RuntimeError("cffCompressor exited with code %d"
+                               % p.returncode)
         if verbose:
             print("Executable returned (delta %gs)" % (time.time() - start_time))
             start_time = time.time()
@@ -373,10 +417,25 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--nrounds', required=False, type=int,
                         help="the number of iterations to run the algorithm"
                              " (defaults to 4)")
+    parser.add_argument('--convergence', required=False, type=float,
+                        help="stop iterating early once the market changes by"
+                             " less than this fraction between rounds")
     parser.add_argument('-m', '--maxsubrs', required=False, type=int,
                         dest='nsubrs_limit', help="limit to the number of "
                                                   " subroutines per INDEX"
                                                   " (defaults to 64K)")
+    parser.add_argument('--maxlength', required=False, type=int,
+                        dest='max_subr_length', help="limit to the number of "
+                                                     "tokens in a candidate "
+                                                     "subroutine")
+    parser.add_argument('--threads', required=False, type=int,
+                        help="the number of threads to run the market on; 1"
+                             " runs it on a single thread (defaults to"
+                             " $COMPREFFOR_THREADS or the number of cores)")
+    parser.add_argument('--suffixsort', required=False,
+                        choices=SUFFIX_SORTS, dest='suffix_sort',
+                        help="how to sort the suffixes of the charstrings"
+                             " (defaults to sais)")
     parser.add_argument('--generatecff', required=False, action='store_true',
                         dest='generate_cff', default=False)
     parser.add_argument('--uselib', required=False, action='store_true',
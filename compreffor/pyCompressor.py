@@ -29,20 +29,34 @@ Usage (in Python):
 """
 
 import os
+import abc
+import ctypes
+import mmap
+import tempfile
 import argparse
+import array
+import bisect
 import itertools
 import unittest
-import functools
 import sys
 import heapq
 import time
+import traceback
 import multiprocessing
 import math
+import Queue
 from collections import deque
 from fontTools import cffLib
 from fontTools.ttLib import TTFont
 from fontTools.misc import psCharStrings
 
+# only the market of `Compreffor.iterative_encode` needs NumPy, so that
+# using the C++ backend doesn't
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 SINGLE_BYTE_OPS = set(['hstem',
                        'vstem',
                        'vmoveto',
@@ -69,7 +83,19 @@ SINGLE_BYTE_OPS = set(['hstem',
                        'vhcurveto',
                        'hvcurveto'])
 
-__all__ = ["CandidateSubr", "SubstringFinder", "Compreffor"]
+__all__ = ["CandidateSubr", "CharstringPool", "CandidateFinder", "SubstringFinder",
+           "MovetoSubstringFinder", "SuffixMethods", "LCPMethods", "MarketPool",
+           "Compreffor"]
+
+class SuffixMethods:
+    """Algorithms available to SubstringFinder for building the suffix array"""
+
+    Sort, SAIS = range(2)
+
+class LCPMethods:
+    """Algorithms available to SubstringFinder for building the LCP array"""
+
+    Kasai, Chunked = range(2)
 
 def tokenCost(token):
         """Calculate the bytecode size of a T2 Charstring token"""
@@ -105,12 +131,13 @@ class CandidateSubr(object):
     length -- length of substring
     location -- tuple of form (glyph_idx, start_pos) where a ref string starts
     freq -- number of times it appears
-    chstrings -- chstrings from whence this substring came
+    chstrings -- chstrings from whence this substring came, either a
+                 CharstringPool or a list of charstrings
     cost_map -- array from simple alphabet -> actual token
     """
 
     __slots__ = ["length", "location", "freq", "chstrings", "cost_map", "_CandidateSubr__cost",
-                 "_adjusted_cost", "_price", "_usages", "_list_idx", "_position", "_encoding",
+                 "_adjusted_cost", "_price", "_usages", "_position", "_encoding",
                  "_program", "_flatten", "_max_call_depth", "_fdidx", "_global"]
 
     def __init__(self, length, ref_loc, freq=0, chstrings=None, cost_map=None):
@@ -134,9 +161,12 @@ class CandidateSubr(object):
 
         assert self.chstrings != None
 
+        if isinstance(self.chstrings, CharstringPool):
+            return self.chstrings.substring(self.location[0], self.location[1], self.length)
         return self.chstrings[self.location[0]][self.location[1]:(self.location[1] + self.length)]
 
-    def subr_saving(self, use_usages=False, true_cost=False, call_cost=5, subr_overhead=3):
+    def subr_saving(self, use_usages=False, true_cost=False, call_cost=5, subr_overhead=3,
+                    memo=None):
         """
         Return the savings that will be realized by subroutinizing
         this substring.
@@ -146,6 +176,7 @@ class CandidateSubr(object):
         true_cost -- take account of subroutine calls
         call_cost -- the cost to call a subroutine
         subr_overhead -- the cost to define a subroutine
+        memo -- passed on to `real_cost` if true_cost is True
         """
 
         # NOTE: call_cost=5 gives better results for some reason
@@ -159,7 +190,7 @@ class CandidateSubr(object):
         if not true_cost:
             cost = self.cost()
         else:
-            cost = self.real_cost(call_cost=call_cost)
+            cost = self.real_cost(call_cost=call_cost, memo=memo)
 
         # TODO:
         # - If substring ends in "endchar", we need no "return"
@@ -172,13 +203,21 @@ class CandidateSubr(object):
                 - call_cost * amt # cost of calling
                 - subr_overhead) # cost of subr definition
 
-    def real_cost(self, call_cost=5):
-        """Account for subroutine calls in cost computation. Not cached because
-        the subroutines used will change over time."""
+    def real_cost(self, call_cost=5, memo=None):
+        """Account for subroutine calls in cost computation. Not cached on
+        the subr because the subroutines used will change over time, but
+        if memo (a dict) is given, the result is looked up in and stored
+        to it. A memo only holds until some subr's _flatten or _encoding
+        changes; see `Compreffor.real_costs`."""
 
+        if memo != None and self in memo:
+            return memo[self]
         cost = self.cost()
-        cost += sum(-it[1].cost() + call_cost if not it[1]._flatten else it[1].real_cost(call_cost=call_cost)
+        cost += sum(-it[1].cost() + call_cost if not it[1]._flatten
+                    else it[1].real_cost(call_cost=call_cost, memo=memo)
                     for it in self.encoding())
+        if memo != None:
+            memo[self] = cost
         return cost
 
     def cost(self):
@@ -190,7 +229,11 @@ class CandidateSubr(object):
             try:
                 return self.__cost
             except AttributeError:
-                self.__cost = sum([self.cost_map[t] for t in self.value()])
+                if isinstance(self.chstrings, CharstringPool):
+                    tokens = self.chstrings.tokens(self.location[0], self.location[1], self.length)
+                else:
+                    tokens = self.value()
+                self.__cost = sum([self.cost_map[t] for t in tokens])
                 return self.__cost
         except:
             raise Exception('Translated token not recognized')
@@ -217,43 +260,159 @@ class CandidateSubr(object):
     def __repr__(self):
         return "<CandidateSubr: %d x %dreps>" % (self.length, self.freq)
 
-class SubstringFinder(object):
+class CharstringPool(object):
     """
-    This class facilitates the finding of repeated substrings
-    within a glyph_set. Typical usage involves creation of an instance
-    and then calling `get_substrings`, which returns a sorted list
-    of `CandidateSubr`s.
+    Flat storage for a set of remapped charstrings, mirroring
+    `charstring_pool_t` in cffCompressor.cc. Indexing by glyph
+    gives that glyph's charstring as a tuple.
+
+    A polynomial rolling hash of the pool is built on the first call to
+    `span_hash`, after which any span of tokens can be hashed by its
+    (start, length) in O(1) without slicing it out.
+
+    Instance variables:
+    pool -- array of every token, glyph after glyph
+    offset -- glyph i occupies pool[offset[i]:offset[i + 1]]
+    rev -- rev[pos] is the glyph that pool[pos] belongs to
+    hashes -- hashes[pos] is the rolling hash of pool[:pos], or None until
+              it is needed
+    powers -- powers[l] is HASH_BASE ** l, up to the longest charstring,
+              or None until it is needed
+    """
+
+    __slots__ = ["pool", "offset", "rev", "hashes", "powers"]
+
+    HASH_BASE = 1000003
+    HASH_MOD = (1 << 31) - 1
+
+    def __init__(self):
+        self.pool = array.array("I")
+        self.offset = array.array("I", [0])
+        self.rev = array.array("I")
+        self.hashes = None
+        self.powers = None
+
+    def append(self, chstring):
+        """Add a charstring (a sequence of remapped tokens) to the pool"""
+
+        glyph_idx = len(self.offset) - 1
+        self.pool.extend(chstring)
+        self.rev.extend(itertools.repeat(glyph_idx, len(chstring)))
+        self.offset.append(len(self.pool))
+        self.hashes = self.powers = None
+
+    def build_hashes(self):
+        """Compute the rolling hash of the whole pool"""
+
+        base = self.HASH_BASE
+        mod = self.HASH_MOD
+        self.hashes = hashes = array.array("l", [0])
+        h = 0
+        for tok in self.pool:
+            h = (h * base + tok + 1) % mod
+            hashes.append(h)
+        longest = 0
+        for i in xrange(len(self)):
+            longest = max(longest, self.offset[i + 1] - self.offset[i])
+        self.powers = powers = array.array("l", [1])
+        while len(powers) <= longest:
+            powers.append(powers[-1] * base % mod)
+
+    def __len__(self):
+        return len(self.offset) - 1
+
+    def __getitem__(self, glyph_idx):
+        return tuple(self.pool[self.offset[glyph_idx]:self.offset[glyph_idx + 1]])
+
+    def __iter__(self):
+        for glyph_idx in xrange(len(self)):
+            yield self[glyph_idx]
+
+    def position(self, glyph_idx, tok_idx):
+        """Return the pool position of token tok_idx of glyph glyph_idx"""
+
+        return self.offset[glyph_idx] + tok_idx
+
+    def location(self, pos):
+        """Return the (glyph_idx, tok_idx) of pool position pos"""
+
+        glyph_idx = self.rev[pos]
+        return (glyph_idx, pos - self.offset[glyph_idx])
+
+    def glyph_end(self, pos):
+        """Return the pool position where the glyph containing pos ends"""
+
+        return self.offset[self.rev[pos] + 1]
+
+    def tokens(self, glyph_idx, tok_idx, length):
+        """Return an array of `length` tokens of glyph_idx from tok_idx"""
+
+        start = self.offset[glyph_idx] + tok_idx
+        return self.pool[start:start + length]
+
+    def substring(self, glyph_idx, tok_idx, length):
+        """Return a tuple of `length` tokens of glyph_idx from tok_idx"""
+
+        return tuple(self.tokens(glyph_idx, tok_idx, length))
+
+    def span_hash(self, start, length):
+        """Return the hash of the `length` tokens at pool position start,
+        which is the same wherever those tokens occur"""
+
+        if self.hashes == None:
+            self.build_hashes()
+        return ((self.hashes[start + length] - self.hashes[start] * self.powers[length])
+                % self.HASH_MOD)
+
+    def spans_equal(self, start, other, length):
+        """Return whether the `length` tokens at pool positions start and
+        other are the same"""
+
+        pool = self.pool
+        for i in xrange(length):
+            if pool[start + i] != pool[other + i]:
+                return False
+        return True
+
+class CandidateFinder(object):
+    """
+    Abstract base class for the engines that find candidate subroutines
+    for Compreffor. An engine is constructed from a glyph_set, remapping
+    its charstrings into a CharstringPool, and `get_substrings` then
+    returns a sorted list of `CandidateSubr`s found in it.
+
+    CandidateFinder itself can't be constructed: subclasses implement
+    `get_substrings`, usually by passing what they find to
+    `select_substrings`. Compreffor takes the engine class as its
+    `finder` option; SubstringFinder and MovetoSubstringFinder, the
+    built-in ones, are those in FINDERS.
 
     Instance variables:
-    suffixes -- sorted array of suffixes
     data --
-      A 2-level array of charstrings:
-        - The first level separates by glyph
-        - The second level separates by token
-            in a glyph's charstring
+      A CharstringPool of the charstrings:
+        - data[i] is the charstring of glyph i
+        - data.pool holds every token contiguously
     alphabet_size -- size of alphabet
     length -- sum of the lengths of the individual glyphstrings
     rev_keymap -- map from simple alphabet -> original tokens
     cost_map -- map from simple alphabet -> bytecost of token
     glyph_set_keys -- glyph_set_keys[i] gives the glyph id for data[i]
-    _completed_suffixes -- boolean whether the suffix array is ready and sorted
+    substrings -- the result of the last `get_substrings` call
     """
 
-    __slots__ = ["suffixes", "data", "alphabet_size", "length", "substrings",
-                 "rev_keymap", "glyph_set_keys", "_completed_suffixes",
-                 "cost_map", "verbose"]
+    __metaclass__ = abc.ABCMeta
+
+    __slots__ = ["data", "alphabet_size", "length", "substrings",
+                 "rev_keymap", "glyph_set_keys", "cost_map", "verbose"]
 
     def __init__(self, glyph_set, verbose=False):
         self.rev_keymap = []
         self.cost_map = []
-        self.data = []
-        self.suffixes = []
+        self.data = CharstringPool()
         self.length = 0
 
         self.process_chstrings(glyph_set)
 
-        self._completed_suffixes = False
-
         self.verbose = verbose 
 
     def process_chstrings(self, glyph_set):
@@ -286,33 +445,147 @@ class SubstringFinder(object):
                     next_key += 1
                 program.append(keymap[tok])
 
-            program = tuple(program)
-            chstr_len = len(program)
-            self.length += chstr_len
-            glyph_idx = len(self.data)
-            self.suffixes.extend(
-                    map(lambda x: (glyph_idx, x), range(chstr_len))
-                )
-            self.data.append(tuple(program))
+            self.length += len(program)
+            self.data.append(program)
 
         self.alphabet_size = next_key
 
+    @abc.abstractmethod
+    def get_substrings(self, min_freq=2, check_positive=True, sort_by_length=False,
+                       max_candidates=None, max_length=None):
+        """
+        Return candidate substrings (type CandidateSubr) from the charstrings
+        with freq >= min_freq, sorted by subroutine savings.
+
+        Arguments:
+        min_freq -- the minimum frequency required to include a substring
+        check_positive -- if True, only allow substrings with positive subr_saving
+        sort_by_length -- if True, return substrings sorted by length, else by saving
+        max_candidates -- if given, only keep this many substrings with the best
+                          subr_saving
+        max_length -- if given, drop substrings longer than this many tokens
+        """
+
+        raise NotImplementedError
+
+    def select_substrings(self, substrings, sort_by_length=False, max_candidates=None,
+                          max_length=None):
+        """Store the substrings from the iterable `substrings` in
+        self.substrings, sorted and capped as for `get_substrings`"""
+
+        if max_length != None:
+            substrings = (s for s in substrings if len(s) <= max_length)
+
+        if max_candidates != None:
+            # same as sorting by saving and truncating, but bounded in memory
+            self.substrings = heapq.nlargest(max_candidates, substrings,
+                                             key=lambda s: s.subr_saving())
+        else:
+            self.substrings = list(substrings)
+
+        if sort_by_length:
+            self.substrings.sort(key=lambda s: len(s))
+        elif max_candidates == None:
+            self.substrings.sort(key=lambda s: s.subr_saving(), reverse=True)
+        return self.substrings
+
+class SubstringFinder(CandidateFinder):
+    """
+    This class facilitates the finding of repeated substrings
+    within a glyph_set. Typical usage involves creation of an instance
+    and then calling `get_substrings`, which returns a sorted list
+    of `CandidateSubr`s. Every branching repeated substring is found
+    using a suffix array and its LCP array.
+
+    Instance variables (in addition to CandidateFinder's):
+    suffixes -- sorted array of suffixes, as positions into data.pool
+    suffix_method -- the SuffixMethods algorithm used to sort the suffixes
+    lcp_method -- the LCPMethods algorithm used to build the LCP array
+    _completed_suffixes -- boolean whether the suffix array is ready and sorted
+    """
+
+    __slots__ = ["suffixes", "_completed_suffixes", "suffix_method", "lcp_method"]
+
+    def __init__(self, glyph_set, verbose=False, suffix_method=SuffixMethods.SAIS,
+                 lcp_method=LCPMethods.Chunked):
+        super(SubstringFinder, self).__init__(glyph_set, verbose)
+
+        self.suffixes = array.array("I", xrange(self.length))
+        self._completed_suffixes = False
+
+        self.suffix_method = suffix_method
+        self.lcp_method = lcp_method
+
     def get_suffixes(self):
         """Return the sorted suffix array"""
 
         if self._completed_suffixes:
             return self.suffixes
 
-        if self.verbose:
-            print("Gettings suffixes via Python sort"); start_time = time.time()
+        if self.suffix_method == SuffixMethods.SAIS:
+            if self.verbose:
+                print("Getting suffixes via SA-IS"); start_time = time.time()
 
-        self.suffixes.sort(key=lambda idx: self.data[idx[0]][idx[1]:])
+            self.suffixes = self.sais_suffixes()
+        elif self.suffix_method == SuffixMethods.Sort:
+            if self.verbose:
+                print("Gettings suffixes via Python sort"); start_time = time.time()
+
+            pool = self.data.pool
+            glyph_end = self.data.glyph_end
+            self.suffixes = array.array("I", sorted(self.suffixes,
+                                        key=lambda pos: pool[pos:glyph_end(pos)]))
+        else:
+            assert 0
         self._completed_suffixes = True
 
         if self.verbose:
             print("Took %gs" % (time.time() - start_time))
         return self.suffixes
 
+    def sais_suffixes(self):
+        """
+        Return the suffixes of self.data in sorted order, computed in
+        linear time with SA-IS.
+
+        The charstrings are concatenated into one text, each followed by
+        its own sentinel. Sentinels sort below every token and in glyph
+        order, so a suffix sorts before any suffix it is a prefix of and
+        identical suffixes keep their glyph order, exactly as the stable
+        Python sort does.
+        """
+
+        num_glyphs = len(self.data)
+        text = self.sentinel_text()
+        suffix_array = sais(text, self.alphabet_size + num_glyphs + 1)
+
+        # glyph glyph_idx starts at text position text_starts[glyph_idx]
+        offset = self.data.offset
+        text_starts = array.array("I", (offset[glyph_idx] + glyph_idx
+                                        for glyph_idx in xrange(num_glyphs)))
+
+        return array.array("I", (t - bisect.bisect_right(text_starts, t) + 1
+                                 for t in suffix_array if text[t] > num_glyphs))
+
+    def sentinel_text(self):
+        """
+        Return the charstrings concatenated into one array, each followed
+        by a sentinel unique to its glyph and the whole terminated by 0.
+        Glyph i's sentinel is i + 1 and token t becomes t + len(data) + 1,
+        so pool position pos is at position pos + data.rev[pos] here.
+        """
+
+        num_glyphs = len(self.data)
+        pool = self.data.pool
+        offset = self.data.offset
+
+        text = array.array("I")
+        for glyph_idx in xrange(num_glyphs):
+            text.extend([tok + num_glyphs + 1 for tok in pool[offset[glyph_idx]:offset[glyph_idx + 1]]])
+            text.append(glyph_idx + 1)
+        text.append(0)
+        return text
+
     def get_lcp(self):
         """Returns the LCP array"""
 
@@ -321,25 +594,40 @@ class SubstringFinder(object):
 
         assert self._completed_suffixes
 
-        rank = [[0 for _ in xrange(len(d_list))] for d_list in self.data]
-        lcp = [0 for _ in xrange(self.length)]
+        if self.lcp_method == LCPMethods.Chunked:
+            return self.chunked_lcp()
+        elif self.lcp_method == LCPMethods.Kasai:
+            return self.kasai_lcp()
+        else:
+            assert 0
+
+    def kasai_lcp(self):
+        """Return the LCP array using Kasai's algorithm over self.data. This
+        is the reference implementation for `chunked_lcp`."""
+
+        pool = self.data.pool
+        offset = self.data.offset
+        glyph_end = self.data.glyph_end
+        suffixes = self.suffixes
+
+        rank = array.array("I", [0]) * self.length
+        lcp = array.array("I", [0]) * self.length
 
         # compute rank array
-        for i in range(self.length):
-            glyph_idx, tok_idx = self.suffixes[i]
-            rank[glyph_idx][tok_idx] = i
+        for i, pos in enumerate(suffixes):
+            rank[pos] = i
 
         for glyph_idx in xrange(len(self.data)):
             cur_h = 0
-            chstring = self.data[glyph_idx]
-            for tok_idx in xrange(len(chstring)):
-                cur_rank = rank[glyph_idx][tok_idx]
+            end = offset[glyph_idx + 1]
+            for pos in xrange(offset[glyph_idx], end):
+                cur_rank = rank[pos]
                 if cur_rank > 0:
-                    last_glidx, last_tidx = self.suffixes[cur_rank - 1]
-                    last_chstring = self.data[last_glidx]
-                    while last_tidx + cur_h < len(last_chstring) and \
-                          tok_idx + cur_h < len(chstring) and \
-                          last_chstring[last_tidx + cur_h] == self.data[glyph_idx][tok_idx + cur_h]:
+                    last_pos = suffixes[cur_rank - 1]
+                    last_end = glyph_end(last_pos)
+                    while last_pos + cur_h < last_end and \
+                          pos + cur_h < end and \
+                          pool[last_pos + cur_h] == pool[pos + cur_h]:
                         cur_h += 1
                     lcp[cur_rank] = cur_h
 
@@ -348,21 +636,70 @@ class SubstringFinder(object):
 
         return lcp
 
-    def get_substrings(self, min_freq=2, check_positive=True, sort_by_length=False):
+    LCP_CHUNK = 16
+
+    def chunked_lcp(self):
+        """
+        Return the LCP array using Kasai's algorithm over the sentinel
+        text, visiting suffixes in text order. Glyph sentinels always
+        mismatch, so no bounds checks are needed, and long common
+        prefixes are compared LCP_CHUNK tokens at a time with array
+        slices before finishing token by token.
         """
-        Return repeated substrings (type CandidateSubr) from the charstrings
-        sorted by subroutine savings with freq >= min_freq using the LCP array. 
+
+        text = self.sentinel_text()
+        rev = self.data.rev
+        suffixes = self.suffixes
+        chunk = self.LCP_CHUNK
+
+        # phi[t] is the text position of the suffix sorted before t
+        phi = array.array("i", [-1]) * len(text)
+        prev = -1
+        for pos in suffixes:
+            t = pos + rev[pos]
+            phi[t] = prev
+            prev = t
+
+        text_lcp = array.array("I", [0]) * len(text)
+        cur_h = 0
+        for t in xrange(len(text)):
+            j = phi[t]
+            if j < 0:
+                # first suffix or a sentinel
+                cur_h = 0
+                continue
+            i = t + cur_h
+            j += cur_h
+            if text[i] == text[j]:
+                i += 1
+                j += 1
+                while text[i:i + chunk] == text[j:j + chunk]:
+                    i += chunk
+                    j += chunk
+                while text[i] == text[j]:
+                    i += 1
+                    j += 1
+                cur_h = i - t
+            text_lcp[t] = cur_h
+
+            if cur_h > 0:
+                cur_h -= 1
+
+        return array.array("I", (text_lcp[pos + rev[pos]] for pos in suffixes))
+
+    def iter_substrings(self, min_freq=2, check_positive=True):
+        """
+        Generate repeated substrings (type CandidateSubr) from the charstrings
+        with freq >= min_freq using the LCP array, in suffix array order.
 
         Arguments:
         min_freq -- the minimum frequency required to include a substring
         check_positive -- if True, only allow substrings with positive subr_saving
-        sort_by_length -- if True, return substrings sorted by length, else by saving
         """
 
         self.get_suffixes()
 
         if self.verbose:
-            print("Extracting substrings"); start_time = time.time()
             print("Getting lcp"); lcp_time = time.time()
 
         lcp = self.get_lcp()
@@ -371,7 +708,6 @@ class SubstringFinder(object):
             print("Took %gs (to get lcp array)" % (time.time() - lcp_time))
 
         start_indices = deque()
-        self.substrings = []
 
         for i, min_l in enumerate(lcp):
             # First min_l items are still the same.
@@ -388,28 +724,208 @@ class SubstringFinder(object):
                 
                 substr = CandidateSubr(
                                        l,
-                                       self.suffixes[start_idx],
+                                       self.data.location(self.suffixes[start_idx]),
                                        freq,
                                        self.data,
                                        self.cost_map)
                 if substr.subr_saving() > 0 or not check_positive:
-                    self.substrings.append(substr)
+                    yield substr
 
             if not start_indices or min_l > start_indices[-1][0]:
                 start_indices.append((min_l, i - 1))
 
+    def get_substrings(self, min_freq=2, check_positive=True, sort_by_length=False,
+                       max_candidates=None, max_length=None):
+        """
+        Return repeated substrings (type CandidateSubr) from the charstrings
+        sorted by subroutine savings with freq >= min_freq using the LCP array. 
+
+        Arguments:
+        min_freq -- the minimum frequency required to include a substring
+        check_positive -- if True, only allow substrings with positive subr_saving
+        sort_by_length -- if True, return substrings sorted by length, else by saving
+        max_candidates -- if given, only keep this many substrings with the best
+                          subr_saving; only that many are held in memory at once
+        max_length -- if given, drop substrings longer than this many tokens
+        """
+
         if self.verbose:
-            print("Took %gs (to extract substrings)" % (time.time() - start_time)); start_time = time.time()
-            print("%d substrings found" % len(self.substrings))
-            print("Sorting...")
-        if sort_by_length:
-            self.substrings.sort(key=lambda s: len(s))
-        else:
-            self.substrings.sort(key=lambda s: s.subr_saving(), reverse=True)
+            print("Extracting substrings"); start_time = time.time()
+
+        self.select_substrings(self.iter_substrings(min_freq, check_positive),
+                               sort_by_length, max_candidates, max_length)
+
         if self.verbose:
-            print("Took %gs (to sort)" % (time.time() - start_time))
+            print("Took %gs (to extract and sort substrings)" % (time.time() - start_time))
+            print("%d substrings found" % len(self.substrings))
         return self.substrings
 
+class MovetoSubstringFinder(CandidateFinder):
+    """
+    A fast, approximate CandidateFinder. Rather than every repeated
+    substring, its candidates are only the runs of operators between
+    consecutive moveto's, i.e. whole contours, that repeat verbatim.
+    """
+
+    __slots__ = []
+
+    def get_substrings(self, min_freq=2, check_positive=True, sort_by_length=False,
+                       max_candidates=None, max_length=None):
+        movetos = set()
+        for idx, tok in enumerate(self.rev_keymap):
+            if isinstance(tok, basestring) and tok[-6:] == "moveto":
+                movetos.add(idx)
+
+        data = self.data
+        spans = []
+        matches = {} # span hash -> spans with that hash
+
+        for glyph_idx in xrange(len(data)):
+            glyph_start = data.offset[glyph_idx]
+            cur_start = 0
+            last_op = -1
+            for pos in xrange(data.offset[glyph_idx + 1] - glyph_start):
+                tok = data.pool[glyph_start + pos]
+                if tok in movetos:
+                    length = last_op + 1 - cur_start
+                    if length > 0:
+                        start = glyph_start + cur_start
+                        bucket = matches.setdefault(data.span_hash(start, length), [])
+                        for span in bucket:
+                            if (span.length == length and
+                                    data.spans_equal(data.position(*span.location),
+                                                     start, length)):
+                                span.freq += 1
+                                break
+                        else:
+                            span = CandidateSubr(length,
+                                                 (glyph_idx, cur_start),
+                                                 1,
+                                                 data,
+                                                 self.cost_map)
+                            bucket.append(span)
+                            spans.append(span)
+                    cur_start = pos + 1
+                elif isinstance(self.rev_keymap[tok], (str, tuple)):
+                    # an operator, or a (hintmask, mask) pair
+                    last_op = pos
+
+        constraints = lambda s: (s.freq >= min_freq and 
+                                (s.subr_saving() > 0 or not check_positive))
+        return self.select_substrings(itertools.ifilter(constraints, spans),
+                                      sort_by_length, max_candidates, max_length)
+
+FINDERS = {"suffix": SubstringFinder,
+           "moveto": MovetoSubstringFinder}
+
+def sais(text, alphabet_size):
+    """
+    Return the suffix array of `text` using the SA-IS algorithm
+    (Nong, Zhang & Chan, 2009).
+
+    Arguments:
+    text -- a sequence of integers in range(alphabet_size), the last
+            of which must be a unique 0 sentinel
+    alphabet_size -- the number of distinct possible values in `text`
+    """
+
+    n = len(text)
+    if n == 1:
+        return [0]
+
+    # classify suffixes as S-type (True) or L-type (False)
+    stype = [False] * n
+    stype[-1] = True
+    for i in xrange(n - 2, -1, -1):
+        stype[i] = text[i] < text[i + 1] or (text[i] == text[i + 1] and stype[i + 1])
+
+    def is_lms(i):
+        return i > 0 and stype[i] and not stype[i - 1]
+
+    counts = [0] * alphabet_size
+    for c in text:
+        counts[c] += 1
+
+    def bucket_heads():
+        heads = [0] * alphabet_size
+        total = 0
+        for c in xrange(alphabet_size):
+            heads[c] = total
+            total += counts[c]
+        return heads
+
+    def bucket_tails():
+        tails = [0] * alphabet_size
+        total = 0
+        for c in xrange(alphabet_size):
+            total += counts[c]
+            tails[c] = total
+        return tails
+
+    def induce(lms_order):
+        suffix_array = [-1] * n
+
+        tails = bucket_tails()
+        for i in reversed(lms_order):
+            c = text[i]
+            tails[c] -= 1
+            suffix_array[tails[c]] = i
+
+        heads = bucket_heads()
+        for k in xrange(n):
+            j = suffix_array[k] - 1
+            if j >= 0 and not stype[j]:
+                c = text[j]
+                suffix_array[heads[c]] = j
+                heads[c] += 1
+
+        tails = bucket_tails()
+        for k in xrange(n - 1, -1, -1):
+            j = suffix_array[k] - 1
+            if j >= 0 and stype[j]:
+                c = text[j]
+                tails[c] -= 1
+                suffix_array[tails[c]] = j
+
+        return suffix_array
+
+    def lms_equal(a, b):
+        if a == n - 1 or b == n - 1:
+            return False
+        k = 0
+        while True:
+            if text[a + k] != text[b + k] or stype[a + k] != stype[b + k]:
+                return False
+            if k > 0 and is_lms(a + k):
+                return is_lms(b + k)
+            k += 1
+
+    lms = [i for i in xrange(1, n) if is_lms(i)]
+
+    # sort LMS substrings, then name them
+    suffix_array = induce(lms)
+    names = [-1] * n
+    cur_name = 0
+    prev = None
+    for pos in suffix_array:
+        if not is_lms(pos):
+            continue
+        if prev != None and not lms_equal(prev, pos):
+            cur_name += 1
+        names[pos] = cur_name
+        prev = pos
+    reduced = [names[pos] for pos in lms]
+
+    # sort LMS suffixes, recursing if the names aren't unique
+    if cur_name + 1 < len(lms):
+        reduced_sa = sais(reduced, cur_name + 1)
+    else:
+        reduced_sa = [0] * len(reduced)
+        for i, c in enumerate(reduced):
+            reduced_sa[c] = i
+
+    return induce([lms[i] for i in reduced_sa])
+
 class Compreffor(object):
     """
     Manager class for the compreffor.
@@ -432,10 +948,18 @@ class Compreffor(object):
     # NSUBRS_LIMIT = 32765 # 32K - 3
     NSUBRS_LIMIT = 65533 # 64K - 3
     SUBR_NEST_LIMIT = 10
+    MAX_CANDIDATES = None
+    MAX_SUBR_LENGTH = None
+    INCREMENTAL = True
+    PRICE_EPSILON = 0
+    CONVERGENCE = None
+    FINDER = SubstringFinder
 
     def __init__(self, font, verbose=False, print_status=False, test_mode=False,
                  chunk_ratio=None, nrounds=None, single_process=None,
-                 processes=None, nsubrs_limit=None):
+                 processes=None, nsubrs_limit=None, max_candidates=None,
+                 max_subr_length=None, incremental=None, price_epsilon=None,
+                 convergence=None, finder=None, pool=None):
         """
         Initialize the compressor.
 
@@ -444,11 +968,34 @@ class Compreffor(object):
         verbose -- if True, print miscellanous info during iterations
         print_status -- if True, print a few status updates
         test_mode -- disables some checks (such as positive subr_saving)
-        chunk_ratio -- sets the POOL_CHUNKRATIO parameter
-        nrounds -- specifies the number of rounds to run
+        chunk_ratio -- sets the POOL_CHUNKRATIO parameter: each round's
+                       work is split into about 1 / chunk_ratio chunks of
+                       equal estimated DP cost (at least one per process)
+        nrounds -- specifies the number of rounds to run, or the most
+                   to run if convergence is given
         single_process -- indicates not to parallelize
         processes -- specify the number of parallel processes
         nsubrs_limit -- specify the limit on the number of subrs in an INDEX
+        max_candidates -- keep only this many initial candidate subrs, those
+                          with the best estimated saving
+        max_subr_length -- the maximum number of tokens in a candidate subr
+        incremental -- if False, re-optimize every charstring in every round
+                       rather than only those affected by price moves
+                       (defaults to True)
+        price_epsilon -- with incremental rounds, only re-optimize the
+                         charstrings touched by a candidate subr whose price
+                         moved more than this since they were last optimized,
+                         or that was cut (defaults to 0, which changes
+                         nothing in the result)
+        convergence -- if given, stop the market early once the set of used
+                       candidate subrs is unchanged between rounds, or the
+                       total market cost or the usage counts change by less
+                       than this fraction
+        finder -- the CandidateFinder class used to find the initial candidate
+                  subrs, or its name in FINDERS (defaults to SubstringFinder)
+        pool -- a MarketPool to run the market with, which is left open so
+                it can serve more fonts (by default one is created and
+                closed for each font)
         """
 
         if isinstance(font, TTFont):
@@ -473,6 +1020,21 @@ class Compreffor(object):
             self.PROCESSES = processes
         if nsubrs_limit != None:
             self.NSUBRS_LIMIT = nsubrs_limit
+        if max_candidates != None:
+            self.MAX_CANDIDATES = max_candidates
+        if max_subr_length != None:
+            self.MAX_SUBR_LENGTH = max_subr_length
+        if incremental != None:
+            self.INCREMENTAL = incremental
+        if price_epsilon != None:
+            self.PRICE_EPSILON = price_epsilon
+        if convergence != None:
+            self.CONVERGENCE = convergence
+        if finder != None:
+            if isinstance(finder, basestring):
+                finder = FINDERS[finder]
+            self.FINDER = finder
+        self.pool = pool
 
     def compress(self):
         """Compress the provided font using the iterative method"""
@@ -508,9 +1070,8 @@ class Compreffor(object):
             for g in top_dict.charset:
                 charstring, sel = top_dict.CharStrings.getItemAndSelector(g)
                 enc = encoding[g]
-                Compreffor.collapse_hintmask(charstring.program)
-                Compreffor.update_program(charstring.program, enc, gbias, lbias, sel)
-                Compreffor.expand_hintmask(charstring.program)
+                charstring.program = Compreffor.encode_program(charstring.program, enc,
+                                                               gbias, lbias, sel)
 
             for fd in top_dict.FDArray:
                 if not hasattr(fd.Private, "Subrs"):
@@ -524,9 +1085,8 @@ class Compreffor(object):
         else:
             for glyph, enc in encoding.iteritems():
                 charstring = top_dict.CharStrings[glyph]
-                Compreffor.collapse_hintmask(charstring.program)
-                Compreffor.update_program(charstring.program, enc, gbias, lbias, 0)
-                Compreffor.expand_hintmask(charstring.program)
+                charstring.program = Compreffor.encode_program(charstring.program, enc,
+                                                               gbias, lbias, 0)
 
             assert len(lsubrs) == 1
 
@@ -554,10 +1114,19 @@ class Compreffor(object):
 
     @staticmethod
     def insert_by_usage(subr, subrs):
-        """Insert subr into subrs mainting a sort by usage"""
-
-        subrs.append(subr)
-        subrs.sort(key=lambda s: s.usages(), reverse=True)
+        """Insert subr into subrs mainting a sort by usage, after
+        any subrs of equal usage"""
+
+        # bisect on the descending usages
+        usages = subr.usages()
+        lo, hi = 0, len(subrs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if subrs[mid].usages() < usages:
+                hi = mid
+            else:
+                lo = mid + 1
+        subrs.insert(lo, subr)
 
     def iterative_encode(self, glyph_set, fdselect=None, fdlen=1):
         """
@@ -572,8 +1141,8 @@ class Compreffor(object):
         fdlen -- the number of FD's in the source font, or 1 if there are none
 
         Returns:
-        A three-part dictionary with keys 'gsubrs', 'lsubrs', and 
-        'glyph_encodings'. The 'glyph_encodings' encoding dictionary
+        A dictionary with keys 'gsubrs', 'lsubrs', 'glyph_encodings'
+        and 'nrounds'. The 'glyph_encodings' encoding dictionary
         specifies how to break up each charstring. Encoding[i]
         describes how to encode glyph i. Each entry is something
         like [(x_1, c_1), (x_2, c_2), ..., (x_k, c_k)], where x_* is an index
@@ -581,15 +1150,20 @@ class Compreffor(object):
         is a CandidateSubr. The 'gsubrs' entry contains an array of global
         subroutines (CandidateSubr objects) and 'lsubrs' is an array indexed
         by FDidx, where each entry is a list of local subroutines.
+        'nrounds' is the number of market rounds that were run.
         """
 
         # generate substrings for marketplace
-        sf = SubstringFinder(glyph_set, verbose=self.verbose)
+        sf = self.FINDER(glyph_set, verbose=self.verbose)
 
         if self.test_mode:
-            substrings = sf.get_substrings(min_freq=0, check_positive=False, sort_by_length=False)
+            substrings = sf.get_substrings(min_freq=0, check_positive=False, sort_by_length=False,
+                                           max_candidates=self.MAX_CANDIDATES,
+                                           max_length=self.MAX_SUBR_LENGTH)
         else:
-            substrings = sf.get_substrings(min_freq=2, check_positive=True, sort_by_length=False)
+            substrings = sf.get_substrings(min_freq=2, check_positive=True, sort_by_length=False,
+                                           max_candidates=self.MAX_CANDIDATES,
+                                           max_length=self.MAX_SUBR_LENGTH)
 
         # TODO remove unnecessary substrings?
 
@@ -599,107 +1173,177 @@ class Compreffor(object):
         glyph_set_keys = sf.glyph_set_keys
         del sf
 
-        if not self.SINGLE_PROCESS:
-            pool = multiprocessing.Pool(processes=self.PROCESSES)
-        else:
-            class DummyPool: pass
-            pool = DummyPool()
-            pool.map = lambda f, *l, **kwargs: map(f, *l)
-
-        substr_dict = {}
-
         start_time = time.time()
 
         if self.verbose:
             print("glyphstrings+substrings=%d" % (len(data) + len(substrings)))
 
-        # set up dictionary with initial values
-        for idx, substr in enumerate(substrings):
-            substr._adjusted_cost = substr.cost()
-            substr._price = substr._adjusted_cost
-            substr._usages = substr.freq # this is the frequency that the substring appears, 
-                                        # not necessarily used
-            substr._list_idx = idx
-            substr_dict[substr.value()] = (idx, substr._price) # NOTE: avoid excess data copying on fork
-                                                               # probably can just pass substr
-                                                               # if threading instead
-
-        for run_count in range(self.NROUNDS):
-            # calibrate prices
-            for idx, substr in enumerate(substrings):
-                marg_cost = float(substr._adjusted_cost) / (substr._usages + self.K)
-                substr._price = marg_cost * self.ALPHA + substr._price * (1 - self.ALPHA)
-                substr_dict[substr.value()] = (idx, substr._price)
-
-            # minimize substring costs
-            csize = int(math.ceil(self.POOL_CHUNKRATIO*len(substrings)))
-            substr_encodings = pool.map(functools.partial(optimize_charstring, 
-                                                          cost_map=cost_map,
-                                                          substr_dict=substr_dict,
-                                                          verbose=self.verbose),
-                                        enumerate([s.value() for s in substrings]),
-                                        chunksize=csize)
-
-            for substr, result in zip(substrings, substr_encodings):
-                substr._encoding = [(enc_item[0], substrings[enc_item[1]]) for enc_item in result["encoding"]]
-                substr._adjusted_cost = result["market_cost"]
-            del substr_encodings
-
-            # minimize charstring costs in current market through DP
-            csize = int(math.ceil(self.POOL_CHUNKRATIO*len(data)))
-            encodings = pool.map(functools.partial(optimize_charstring,
-                                                   cost_map=cost_map,
-                                                   substr_dict=substr_dict,
-                                                   verbose=self.verbose),
-                                 data,
-                                 chunksize=csize)
-            encodings = [[(enc_item[0], substrings[enc_item[1]]) for enc_item in i["encoding"]] for i in encodings]
-
-            # update substring frequencies based on cost minimization
-            for substr in substrings:
-                substr._usages = 0
-
-            for calling_substr in substrings:
-                for start, substr in calling_substr._encoding:
-                    if substr:
-                        substr._usages += 1
-            for glyph_idx, enc in enumerate(encodings):
-                for start, substr in enc:
-                    if substr:
-                        substr._usages += 1
-
-            if self.verbose or self.print_status:
-                print("Round %d Done!" % (run_count + 1))
-                print("avg: %f" % (float(sum(substr._usages for substr in substrings)) / len(substrings)))
-                print("max: %d" % max(substr._usages for substr in substrings))
-                print("used: %d" % sum(substr._usages > 0 for substr in substrings))
-
-            if run_count <= self.NROUNDS - 2 and not self.test_mode:
-                cutdown_time = time.time()
-                if run_count < self.NROUNDS - 2:
-                    bad_substrings = [s for s in substrings if s.subr_saving(use_usages=True) <= 0]
-                    substrings = [s for s in substrings if s.subr_saving(use_usages=True) > 0]
+        # set up initial values
+        table = CandidateTable(substrings)
+        candidates = substrings
+        live = np.arange(len(table))
+
+        # the workers get the market once, then only its prices each round
+        market = MarketData.from_candidates(data, cost_map, candidates,
+                                            verbose=self.verbose)
+        if self.pool != None:
+            pool = self.pool
+        elif not self.SINGLE_PROCESS:
+            pool = MarketPool(processes=self.PROCESSES)
+        else:
+            pool = MarketPool(processes=0)
+        try:
+            pool.load_market(market)
+
+            # with incremental rounds, the encodings of the previous round are
+            # kept along with the candidates matched in each charstring, and a
+            # charstring is only re-optimized if one of the candidates in its
+            # encoding moved in price or was cut, or a matched one got cheaper
+            incremental = self.INCREMENTAL
+            encodings = [None for _ in data]
+            glyph_matches = [None for _ in data]
+            substr_matches = [None for _ in candidates]
+            dp_prices = np.empty(len(table))
+            dp_prices.fill(np.nan)
+            moved = set()
+
+            # with adaptive rounds, NROUNDS is only the most to run
+            adaptive = self.CONVERGENCE != None
+            nrounds = self.NROUNDS
+            glyph_costs = [None for _ in data]
+            last_cost = last_usages = None
+
+            run_count = 0
+            while run_count < nrounds:
+                # calibrate prices
+                table.calibrate(live, self.ALPHA, self.K)
+
+                # publish this round's market for the DP
+                market.set_prices(live.tolist(), table.price[live].tolist())
+                window = int(table.length[live].max()) if len(live) else 0
+
+                # find what needs (re-)optimizing
+                if incremental:
+                    prices = table.price[live]
+                    last_prices = dp_prices[live]
+                    unset = np.isnan(last_prices)
+                    delta = np.where(unset, 0, prices - last_prices)
+                    moving = np.abs(delta) > self.PRICE_EPSILON
+                    moved.update(live[moving].tolist())
+                    fell = set(live[moving & (delta < 0)].tolist())
+                    update = moving | unset
+                    dp_prices[live[update]] = prices[update]
+
+                    def is_stale(encoding, matches):
+                        return (matches == None or
+                                any(s in moved for _, s in encoding) or
+                                any(s in fell for s in matches))
+
+                    dirty_substrs = [i for i in live.tolist()
+                                     if is_stale(table.encodings[i], substr_matches[i])]
+                    dirty_glyphs = [i for i in xrange(len(data))
+                                    if is_stale(encodings[i], glyph_matches[i])]
+                    moved = set()
                 else:
-                    bad_substrings = [s for s in substrings if s.subr_saving(use_usages=True, true_cost=False) <= 0]
-                    substrings = [s for s in substrings if s.subr_saving(use_usages=True, true_cost=False) > 0]
-
-                for substr in bad_substrings:
-                    # heuristic to encourage use of called substrings:
-                    for idx, called_substr in substr._encoding:
-                        called_substr._usages += substr._usages - 1
-                    del substr_dict[substr.value()]
-                for idx, s in enumerate(substrings):
-                    s._list_idx = idx
+                    dirty_substrs = live.tolist()
+                    dirty_glyphs = range(len(data))
+
+                # minimize substring costs
+                nchunks = int(math.ceil(1 / self.POOL_CHUNKRATIO))
+                substr_encodings = pool.optimize("substrings",
+                                                 dirty_substrs,
+                                                 nchunks,
+                                                 window,
+                                                 incremental)
+
+                for substr, result in zip(dirty_substrs, substr_encodings):
+                    table.encodings[substr] = result["encoding"]
+                    table.adjusted_cost[substr] = result["market_cost"]
+                    if incremental:
+                        substr_matches[substr] = result["matches"]
+                del substr_encodings
+
+                # minimize charstring costs in current market through DP
+                glyph_encodings = pool.optimize("glyphs",
+                                                dirty_glyphs,
+                                                nchunks,
+                                                window,
+                                                incremental)
+                for glyph_idx, result in zip(dirty_glyphs, glyph_encodings):
+                    encodings[glyph_idx] = result["encoding"]
+                    glyph_costs[glyph_idx] = result["market_cost"]
+                    if incremental:
+                        glyph_matches[glyph_idx] = result["matches"]
+                del glyph_encodings
+
+                if self.verbose and incremental:
+                    print("Re-optimized %d substrings and %d glyphs" % (len(dirty_substrs), len(dirty_glyphs)))
+
+                # update substring frequencies based on cost minimization
+                table.count_usages(live, encodings)
+
+                if self.verbose or self.print_status:
+                    usages = table.usages[live]
+                    print("Round %d Done!" % (run_count + 1))
+                    print("avg: %f" % (float(usages.sum()) / len(live)))
+                    print("max: %d" % usages.max())
+                    print("used: %d" % (usages > 0).sum())
+
+                if adaptive:
+                    market_cost = sum(glyph_costs)
+                    usages = dict((i, u) for i, u in zip(live.tolist(), table.usages[live].tolist())
+                                  if u > 0)
+                    if last_usages != None and Compreffor.market_converged(
+                                                            last_cost, market_cost,
+                                                            last_usages, usages,
+                                                            self.CONVERGENCE):
+                        # the cutdown before the last round must be the final one
+                        nrounds = min(nrounds, run_count + 2)
+                        if self.test_mode:
+                            nrounds = run_count + 1
+                    last_cost = market_cost
+                    last_usages = usages
+
+                if run_count <= nrounds - 2 and not self.test_mode:
+                    cutdown_time = time.time()
+                    keep = table.subr_saving(live) > 0
+                    bad_substrings = live[~keep].tolist()
+                    live = live[keep]
+
+                    for substr in bad_substrings:
+                        # heuristic to encourage use of called substrings:
+                        for idx, called_substr in table.encodings[substr]:
+                            table.usages[called_substr] += table.usages[substr] - 1
+                        market.prices[substr] = -1
+                        if incremental:
+                            moved.add(substr)
+                            substr_matches[substr] = None
+                            dp_prices[substr] = np.nan
+                    if self.verbose:
+                        print("%d substrings with non-positive savings removed" % len(bad_substrings))
+                        print("(%d had positive usage)" % (table.usages[bad_substrings] > 0).sum())
+                        print("Took %gs to cutdown" % (time.time() - cutdown_time))
+
+                    if adaptive and run_count == nrounds - 2 and not bad_substrings:
+                        # nothing was cut, so this round's encodings are final
+                        nrounds = run_count + 1
+
                 if self.verbose:
-                    print("%d substrings with non-positive savings removed" % len(bad_substrings))
-                    print("(%d had positive usage)" % len([s for s in bad_substrings if s._usages > 0]))
-                    print("Took %gs to cutdown" % (time.time() - cutdown_time))
+                    print("")
 
-            if self.verbose:
-                print("")
+                run_count += 1
+        finally:
+            if pool != self.pool:
+                pool.close()
+                pool.join()
+
+        substrings = table.materialize(live)
+        encodings = [[(pos, candidates[substr]) for pos, substr in enc] for enc in encodings]
 
         if self.verbose or self.print_status:
             print("Finished iterative market (%gs)" % (time.time() - start_time))
+            print("Worker busy time: %s" % ", ".join("%.2fs" % t for t in pool.busy_times))
+            print("Ran %d rounds" % run_count)
             print("%d candidate subrs found" % len(substrings))
 
         gsubrs, lsubrs = Compreffor.process_subrs(
@@ -715,34 +1359,47 @@ class Compreffor(object):
 
         return {"glyph_encodings": dict(zip(glyph_set_keys, encodings)),
                 "lsubrs": lsubrs,
-                "gsubrs": gsubrs}
+                "gsubrs": gsubrs,
+                "nrounds": run_count}
 
     @staticmethod
-    def process_subrs(glyph_set_keys, encodings, fdlen, fdselect, substrings, rev_keymap, subr_limit, nest_limit, verbose=False):
-        post_time = time.time()
+    def market_converged(last_cost, cost, last_usages, usages, threshold):
+        """Return whether the market settled between two rounds, given each
+        round's total market cost and the usage counts of the used subrs"""
 
-        def mark_reachable(cand_subr, fdidx):
-            try:
-                if fdidx not in cand_subr._fdidx:
-                    cand_subr._fdidx.append(fdidx)
-            except AttributeError:
-                cand_subr._fdidx = [fdidx]
-
-            for it in cand_subr._encoding:
-                mark_reachable(it[1], fdidx)
-        if fdselect != None:
-            for g, enc in zip(glyph_set_keys, encodings):
-                sel = fdselect(g)
-                for it in enc:
-                    mark_reachable(it[1], sel)
-        else:
-            for encoding in encodings:
-                for it in encoding:
-                    mark_reachable(it[1], 0)
+        if set(last_usages) == set(usages):
+            return True
+
+        cost_change = abs(cost - last_cost) / max(float(cost), 1)
+        usage_change = sum(abs(u - last_usages.get(s, 0)) for s, u in usages.iteritems())
+        usage_change += sum(u for s, u in last_usages.iteritems() if s not in usages)
+        usage_change = float(usage_change) / max(sum(usages.itervalues()), 1)
+        return cost_change < threshold or usage_change < threshold
 
-        subrs = [s for s in substrings if s.usages() > 0 and hasattr(s, '_fdidx') and  bool(s._fdidx) and s.subr_saving(use_usages=True, true_cost=True) > 0]
+    @staticmethod
+    def process_subrs(glyph_set_keys, encodings, fdlen, fdselect, substrings, rev_keymap, subr_limit, nest_limit, verbose=False):
+        post_time = time.time()
 
-        bad_substrings = [s for s in substrings if s.usages() == 0 or not hasattr(s, '_fdidx') or not bool(s._fdidx) or s.subr_saving(use_usages=True, true_cost=True) <= 0]
+        # mark which FDs reach each subr, as a bitset, callers first
+        fdbits = {}
+        for g, enc in zip(glyph_set_keys, encodings):
+            bit = 1 << (fdselect(g) if fdselect != None else 0)
+            for it in enc:
+                fdbits[it[1]] = fdbits.get(it[1], 0) | bit
+        callees = lambda s: [it[1] for it in s._encoding]
+        for subr in topological_order(list(fdbits), callees):
+            bits = fdbits[subr]
+            for callee in callees(subr):
+                fdbits[callee] = fdbits.get(callee, 0) | bits
+            subr._fdidx = [fdidx for fdidx in xrange(fdlen) if bits >> fdidx & 1]
+
+        used = [s for s in substrings if s.usages() > 0 and hasattr(s, '_fdidx') and bool(s._fdidx)]
+        memo = Compreffor.real_costs(used)
+        savings = dict((s, s.subr_saving(use_usages=True, true_cost=True, memo=memo))
+                       for s in used)
+        subrs = [s for s in used if savings[s] > 0]
+
+        bad_substrings = [s for s in substrings if s not in savings or savings[s] <= 0]
         if verbose:
             print("%d substrings unused or negative saving subrs" % len(bad_substrings))
 
@@ -752,7 +1409,9 @@ class Compreffor(object):
         gsubrs = []
         lsubrs = [[] for _ in xrange(fdlen)]
 
-        subrs.sort(key=lambda s: s.subr_saving(use_usages=True, true_cost=True))
+        # flattening changed the real costs
+        memo = Compreffor.real_costs(subrs)
+        subrs.sort(key=lambda s: s.subr_saving(use_usages=True, true_cost=True, memo=memo))
 
         while subrs and (any(len(s) < subr_limit for s in lsubrs) or 
                          len(gsubrs) < subr_limit):
@@ -795,8 +1454,7 @@ class Compreffor(object):
         map(set_flatten, bad_substrings)
 
         # fix any nesting issues
-        Compreffor.calc_nesting(gsubrs)
-        map(Compreffor.calc_nesting, lsubrs)
+        Compreffor.calc_nesting(list(itertools.chain(gsubrs, *lsubrs)))
 
         too_nested = [s for s in itertools.chain(*lsubrs) if s._max_call_depth > nest_limit]
         too_nested.extend([s for s in gsubrs if s._max_call_depth > nest_limit])
@@ -831,10 +1489,9 @@ class Compreffor(object):
             # NOTE: it is important this is run in order so shorter
             # substrings are run before longer ones
             if hasattr(subr, '_fdidx') and len(subr._fdidx) > 0:
-                program = [rev_keymap[tok] for tok in subr.value()]
-                Compreffor.update_program(program, subr.encoding(), gbias, lbias, None)
-                Compreffor.expand_hintmask(program)
-                subr._program = program
+                program = (rev_keymap[tok] for tok in subr.value())
+                subr._program = Compreffor.encode_program(program, subr.encoding(),
+                                                          gbias, lbias, None)
 
         for subr_arr, sel in zip(itertools.chain([gsubrs], lsubrs),
                                   itertools.chain([None], xrange(fdlen))):
@@ -842,37 +1499,46 @@ class Compreffor(object):
                 program = [rev_keymap[tok] for tok in subr.value()]
                 if program[-1] not in ("endchar", "return"):
                     program.append("return")
-                Compreffor.update_program(program, subr.encoding(), gbias, lbias, sel)
-                Compreffor.expand_hintmask(program)
-                subr._program = program
+                subr._program = Compreffor.encode_program(program, subr.encoding(),
+                                                          gbias, lbias, sel)
 
         if verbose:
             print("POST-TIME: %gs" % (time.time() - post_time))
 
         return (gsubrs, lsubrs)
 
+    @staticmethod
+    def real_costs(substrings, call_cost=5):
+        """Return a memo for `CandidateSubr.real_cost` holding the real cost
+        of substrings and of the flattened subrs they call, computed
+        bottom-up over the call graph. It is only valid until some subr's
+        _flatten or _encoding changes."""
+
+        flattened = lambda s: [it[1] for it in s._encoding if it[1]._flatten]
+        memo = {}
+        for subr in reversed(topological_order(substrings, flattened)):
+            subr.real_cost(call_cost=call_cost, memo=memo)
+        return memo
+
     @staticmethod
     def calc_nesting(subrs):
-        """Update each entry of subrs with their call depth. This
+        """Update each entry of subrs, and each subr they call, with their
+        call depth: 1 for the entries of subrs, and one more than their
+        deepest caller for the rest, looking through flattened subrs. This
         is stored in the '_max_call_depth' attribute of the subr"""
 
-        def increment_subr_depth(subr, depth):
-            if not hasattr(subr, "_max_call_depth") or subr._max_call_depth < depth:
+        # depth of the code in each subr's body, which for a flattened
+        # subr is that of its deepest caller
+        depths = {}
+        for subr in topological_order(subrs, lambda s: [it[1] for it in s._encoding]):
+            depth = depths.setdefault(subr, 1)
+            if not subr._flatten and getattr(subr, "_max_call_depth", 0) < depth:
                 subr._max_call_depth = depth
-
-            callees = deque([it[1] for it in subr._encoding])
-
-            while len(callees):
-                next_subr = callees.pop()
-                if next_subr._flatten:
-                    callees.extend([it[1] for it in next_subr._encoding])
-                elif (not hasattr(next_subr, "_max_call_depth") or 
-                            next_subr._max_call_depth < depth + 1):
-                        increment_subr_depth(next_subr, depth + 1)
-
-        for subr in subrs:
-            if not hasattr(subr, "_max_call_depth"):
-                increment_subr_depth(subr, 1)
+            for it in subr._encoding:
+                callee = it[1]
+                callee_depth = depth if callee._flatten else depth + 1
+                if depths.get(callee, 0) < callee_depth:
+                    depths[callee] = callee_depth
 
     @staticmethod
     def update_program(program, encoding, gbias, lbias_arr, fdidx):
@@ -889,16 +1555,53 @@ class Compreffor(object):
         fdidx -- the FD that this `program` belongs to, or None if global
         """
 
-        offset = 0
+        program[:] = Compreffor.encode_program(program, encoding, gbias, lbias_arr,
+                                               fdidx, expand=False)
+        return program
+
+    @staticmethod
+    def encode_program(program, encoding, gbias=None, lbias_arr=None, fdidx=None,
+                       expand=True):
+        """
+        Return a new program with the provided `encoding` applied to
+        `program`, built in one pass. Hintmasks in `program` may be
+        collapsed or not, the positions in `encoding` count a hintmask
+        and its mask as one token. In the result, hintmasks are expanded
+        into two tokens, or collapsed if `expand` is False.
+
+        Arguments as for `update_program`, where program can be any
+        iterable of tokens.
+        """
+
+        def collapsed():
+            piter = iter(program)
+            for tok in piter:
+                if tok in ("hintmask", "cntrmask"):
+                    tok = (tok, next(piter))
+                yield tok
+
+        result = []
+        if expand:
+            def emit(toks):
+                for tok in toks:
+                    if isinstance(tok, tuple):
+                        assert tok[0] in ("hintmask", "cntrmask")
+                        result.extend(tok)
+                    else:
+                        result.append(tok)
+        else:
+            emit = result.extend
+
+        toks = collapsed()
+        pos = 0
         for item in encoding:
             subr = item[1]
-            s = slice(item[0] - offset, item[0] + subr.length - offset)
+            emit(itertools.islice(toks, item[0] - pos))
             if subr._flatten:
-                program[s] = subr._program
-                offset += subr.length - len(subr._program)
+                result.extend(subr._program)
             else:
                 assert hasattr(subr, "_position"), \
-                        "CandidateSubr without position in Subrs encountered"   
+                        "CandidateSubr without position in Subrs encountered"
 
                 if subr._global:
                     operator = "callgsubr"
@@ -909,76 +1612,253 @@ class Compreffor(object):
                     assert fdidx == None or subr._fdidx[0] == fdidx
                     operator = "callsubr"
                     bias = lbias_arr[subr._fdidx[0]]
-                    
-                program[s] = [subr._position - bias, operator]
-                offset += subr.length - 2
-        return program
+
+                result.append(subr._position - bias)
+                result.append(operator)
+            # skip the tokens the subr replaces
+            for _ in itertools.islice(toks, subr.length):
+                pass
+            pos = item[0] + subr.length
+        emit(toks)
+        return result
 
     @staticmethod
     def collapse_hintmask(program):
         """Takes in a charstring and returns the same charstring
         with hintmasks combined into a single element"""
 
-        piter = iter(enumerate(program))
-
-        for i, tok in piter:
-            if tok in ("hintmask", "cntrmask"):
-                program[i:i+2] = [(program[i], program[i+1])]
-
+        program[:] = Compreffor.encode_program(program, (), expand=False)
 
     @staticmethod
     def expand_hintmask(program):
         """Expands collapsed hintmask tokens into two tokens"""
 
-        piter = iter(enumerate(program))
+        program[:] = Compreffor.encode_program(program, ())
 
-        for i, tok in piter:
-            if isinstance(tok, tuple):
-                assert tok[0] in ("hintmask", "cntrmask")
-                program[i:i+1] = tok
+class CandidateTable(object):
+    """
+    Market state of the candidate subrs in `iterative_encode`, kept as
+    one NumPy column per field with a row per candidate (its list_idx),
+    so a round's price calibration, usage counting and cutdown run as
+    array operations. The CandidateSubr objects only get their state
+    back, with `materialize`, once the market is done.
 
-def optimize_charstring(charstring, cost_map, substr_dict, verbose):
-    """Optimize a charstring (encoded using keymap) using
-    the substrings in substr_dict. This is the Dynamic Programming portion
-    of `iterative_encode`."""
-
-    if len(charstring) > 1 and type(charstring[1]) == tuple:
-        if type(charstring[0]) == int:
-            skip_idx = charstring[0]
-            charstring = charstring[1]
-            glyph_key = None
-    else:
-        skip_idx = None
+    Instance variables:
+    candidates -- the CandidateSubr of each row
+    glyph -- glyph index of each candidate's reference string
+    start -- token index of each candidate's reference string
+    length -- number of tokens in each candidate
+    freq -- number of times each candidate appears
+    cost -- bytecost of each candidate
+    price -- market price of each candidate
+    adjusted_cost -- market cost of each candidate's own encoding
+    usages -- calls to each candidate in the current encodings
+    encodings -- encoding of each candidate as (position, list_idx) pairs,
+                 or None before it is first optimized
+    """
+
+    __slots__ = ["candidates", "glyph", "start", "length", "freq", "cost",
+                 "price", "adjusted_cost", "usages", "encodings"]
+
+    def __init__(self, candidates):
+        if np == None:
+            raise ImportError("the Python backend's market needs NumPy")
+        n = len(candidates)
+        self.candidates = candidates
+        self.glyph = np.fromiter((c.location[0] for c in candidates), np.int64, n)
+        self.start = np.fromiter((c.location[1] for c in candidates), np.int64, n)
+        self.length = np.fromiter((c.length for c in candidates), np.int64, n)
+        self.freq = np.fromiter((c.freq for c in candidates), np.int64, n)
+        self.cost = np.fromiter((c.cost() for c in candidates), np.int64, n)
+        self.adjusted_cost = self.cost.astype(np.float64)
+        self.price = self.adjusted_cost.copy()
+        # this is the frequency that the substring appears,
+        # not necessarily used
+        self.usages = self.freq.copy()
+        self.encodings = [None for _ in candidates]
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def calibrate(self, rows, alpha, k):
+        """Move the price of the candidates `rows` toward their marginal
+        cost, (adjusted_cost / (usages + k)), by a factor of alpha"""
+
+        marg_cost = self.adjusted_cost[rows] / (self.usages[rows] + k)
+        self.price[rows] = marg_cost * alpha + self.price[rows] * (1 - alpha)
+
+    def count_usages(self, rows, glyph_encodings):
+        """Set usages to the number of calls to each candidate made by
+        the candidates `rows` and the glyph encodings"""
+
+        # flatten the (position, list_idx) pairs of every encoding into
+        # one array, without a Python-level loop over the calls
+        encodings = itertools.chain((self.encodings[i] for i in rows.tolist()),
+                                    glyph_encodings)
+        pairs = np.fromiter(itertools.chain.from_iterable(
+                                itertools.chain.from_iterable(encodings)),
+                            np.int64)
+        self.usages = np.bincount(pairs[1::2],
+                                  minlength=len(self)).astype(np.int64)
+
+    def subr_saving(self, rows, call_cost=5, subr_overhead=3):
+        """The `CandidateSubr.subr_saving` (use_usages=True) of the
+        candidates `rows`"""
+
+        cost = self.cost[rows]
+        amt = self.usages[rows]
+        return cost * amt - cost - call_cost * amt - subr_overhead
+
+    def materialize(self, rows):
+        """Write the market state of the candidates `rows` back onto their
+        CandidateSubr objects and return those, in order"""
+
+        substrings = []
+        for i in rows.tolist():
+            substr = self.candidates[i]
+            substr._price = float(self.price[i])
+            substr._adjusted_cost = float(self.adjusted_cost[i])
+            substr._usages = int(self.usages[i])
+            substr._encoding = [(pos, self.candidates[j]) for pos, j in self.encodings[i]]
+            substrings.append(substr)
+        return substrings
+
+class SubstringTrie(object):
+    """
+    Token trie indexing the candidate substrings of a market, so that
+    `optimize_charstring` only follows substrings that exist. Nodes are
+    numbered from 0 (the root) and the edges kept in one flat dict.
+    The trie is built once per market; the prices change every round
+    and candidates leave the market by getting a negative price.
+
+    Instance variables:
+    alphabet_size -- size of the token alphabet
+    edges -- maps node * alphabet_size + token -> child node
+    entries -- entries[node] is the list_idx of the substring spelled
+               out by node, or None
+    prices -- prices[list_idx] is the price of that substring, or
+              negative if it is not in the market
+    max_length -- length of the longest substring added
+    """
 
-    results = [0 for _ in xrange(len(charstring) + 1)]
-    next_enc_idx = [None for _ in xrange(len(charstring))]
-    next_enc_substr = [None for _ in xrange(len(charstring))]
-    for i in reversed(range(len(charstring))):
+    __slots__ = ["alphabet_size", "edges", "entries", "prices", "max_length"]
+
+    def __init__(self, alphabet_size, prices=None):
+        self.alphabet_size = alphabet_size
+        self.edges = {}
+        self.entries = [None]
+        self.prices = prices
+        self.max_length = 0
+
+    def add(self, tokens, entry):
+        """Set the entry (list_idx) for the substring `tokens`"""
+
+        node = 0
+        for tok in tokens:
+            key = node * self.alphabet_size + tok
+            child = self.edges.get(key)
+            if child == None:
+                child = len(self.entries)
+                self.edges[key] = child
+                self.entries.append(None)
+            node = child
+        self.entries[node] = entry
+        self.max_length = max(self.max_length, len(tokens))
+
+    def get(self, tokens):
+        """Return the entry for the substring `tokens`, or None"""
+
+        node = 0
+        for tok in tokens:
+            node = self.edges.get(node * self.alphabet_size + tok)
+            if node == None:
+                return None
+        return self.entries[node]
+
+def optimize_charstring(charstring, cost_map, substr_trie, verbose, window=None,
+                        matches=False, skip_idx=None):
+    """Optimize a charstring (encoded using keymap) using
+    the substrings in substr_trie. This is the Dynamic Programming portion
+    of `iterative_encode`.
+
+    If window is given (at least the length of the longest substring),
+    only encodings of at most window + 1 tokens are tried from each
+    position, which runs in O(n * window) and gives the same result: a
+    longer run of raw tokens never costs less than its first window + 1
+    tokens followed by the best encoding of the rest.
+
+    If matches is True, the result also lists the substrings that occur
+    in the charstring (by list_idx, possibly repeated) under "matches".
+
+    When optimizing a substring, skip_idx is its list_idx, so that it is
+    not encoded as a call to itself."""
+
+    edges = substr_trie.edges
+    entries = substr_trie.entries
+    prices = substr_trie.prices
+    alphabet_size = substr_trie.alphabet_size
+
+    length = len(charstring)
+    if window == None:
+        window = length
+    matched = []
+    results = [0 for _ in xrange(length + 1)]
+    next_enc_idx = [None for _ in xrange(length)]
+    next_enc_substr = [None for _ in xrange(length)]
+    for i in reversed(range(length)):
         min_option = float("inf")
-        min_enc_idx = len(charstring)
+        min_enc_idx = length
         min_enc_substr = None
         cur_cost = 0
-        for j in range(i + 1, len(charstring) + 1):
-            cur_cost += cost_map[charstring[j - 1]]
-
-            if charstring[i:j] in substr_dict:
-                substr = substr_dict[charstring[i:j]]
-                if substr[0] != skip_idx:
-                    option = substr[1] + results[j]
-                    substr = substr[0]
+        node = 0
+        j = i + 1
+        stop = min(length, i + window + 1)
+
+        # walk the trie while charstring[i:j] is a prefix of some substring
+        while j <= stop:
+            tok = charstring[j - 1]
+            cur_cost += cost_map[tok]
+            node = edges.get(node * alphabet_size + tok)
+            if node == None:
+                break
+
+            substr = entries[node]
+            if substr != None and prices[substr] >= 0:
+                if substr != skip_idx:
+                    option = prices[substr] + results[j]
+                    if matches:
+                        matched.append(substr)
                 else:
-                    assert i == 0 and j == len(charstring)
+                    assert i == 0 and j == length
                     substr = None
                     option = cur_cost + results[j]
             else:
                 # note: must not be branching, so just make _price actual cost
                 substr = None
                 option = cur_cost + results[j]
-            
+
             if option < min_option:
                 min_option = option
                 min_enc_idx = j
                 min_enc_substr = substr
+            j += 1
+        else:
+            cur_cost = None
+
+        # no longer substrings can match, the rest are just tokens
+        if cur_cost != None:
+            option = cur_cost + results[j]
+            if option < min_option:
+                min_option = option
+                min_enc_idx = j
+                min_enc_substr = None
+            for j in xrange(j + 1, stop + 1):
+                cur_cost += cost_map[charstring[j - 1]]
+                option = cur_cost + results[j]
+                if option < min_option:
+                    min_option = option
+                    min_enc_idx = j
+                    min_enc_substr = None
 
         results[i] = min_option
         next_enc_idx[i] = min_enc_idx
@@ -1000,10 +1880,412 @@ def optimize_charstring(charstring, cost_map, substr_dict, verbose):
 
     if verbose:
         sys.stdout.write("."); sys.stdout.flush()
-    return {"encoding": encoding, "market_cost": market_cost}
+    result = {"encoding": encoding, "market_cost": market_cost}
+    if matches:
+        result["matches"] = matched
+    return result
+
+class MarketData(object):
+    """
+    What the DP needs to know of a market. Its flat arrays (the token
+    pool, the glyph offsets, the cost map and the candidate spans) are
+    what a MarketPool shares with its workers, through a memory-mapped
+    file that each worker attaches to once per font; the trie is rebuilt
+    from them, and after that only price changes are sent between rounds.
+
+    Instance variables:
+    pool -- every token, glyph after glyph (as in a CharstringPool)
+    offset -- glyph i occupies pool[offset[i]:offset[i + 1]]
+    cost_map -- map from simple alphabet -> bytecost of token
+    spans -- (start, length) of each candidate in pool, flattened
+    substr_trie -- SubstringTrie of all candidates, holding `prices`
+    prices -- price of each candidate by list_idx, or -1 if not in the market
+    verbose -- passed on to `optimize_charstring`
+    """
+
+    __slots__ = ["pool", "offset", "cost_map", "spans", "substr_trie", "prices",
+                 "verbose"]
+
+    # the arrays shared with workers, all of 32-bit ints
+    SHARED = ["pool", "offset", "cost_map", "spans"]
+
+    def __init__(self, pool, offset, cost_map, spans, verbose=False):
+        self.pool = pool
+        self.offset = offset
+        self.cost_map = cost_map
+        self.spans = spans
+        self.verbose = verbose
+
+        self.prices = array.array("d", [-1]) * (len(spans) // 2)
+        self.substr_trie = SubstringTrie(len(cost_map), self.prices)
+        for idx in xrange(len(spans) // 2):
+            start, length = spans[2 * idx], spans[2 * idx + 1]
+            self.substr_trie.add(pool[start:start + length], idx)
 
+    @staticmethod
+    def from_candidates(data, cost_map, substrings, verbose=False):
+        """Return the MarketData of the CandidateSubrs `substrings` of the
+        glyphs in CharstringPool data"""
+
+        spans = array.array("I")
+        for substr in substrings:
+            glyph_idx, tok_idx = substr.location
+            spans.append(data.position(glyph_idx, tok_idx))
+            spans.append(len(substr))
+        return MarketData(data.pool, data.offset, array.array("I", cost_map),
+                          spans, verbose)
+
+    def share(self):
+        """Write the shared arrays to a temporary file and return its path
+        and the length of each array, for `attach`. The caller removes
+        the file once every worker has attached to it."""
+
+        fd, path = tempfile.mkstemp(prefix="compreffor-market-")
+        with os.fdopen(fd, "wb") as f:
+            for name in self.SHARED:
+                array.array("I", getattr(self, name)).tofile(f)
+        return path, [len(getattr(self, name)) for name in self.SHARED]
 
+    @staticmethod
+    def attach(path, lengths, verbose=False):
+        """Return the MarketData whose arrays were written to path by
+        `share`, viewing them in place in a private mapping of the file"""
+
+        with open(path, "rb") as f:
+            shared = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        arrays = []
+        pos = 0
+        for length in lengths:
+            arrays.append((ctypes.c_int * length).from_buffer(shared, pos))
+            pos += length * ctypes.sizeof(ctypes.c_int)
+        return MarketData(*arrays, verbose=verbose)
+
+    def set_prices(self, indices, prices):
+        """Apply a price update, as parallel arrays of list_idx and price"""
+
+        for idx, price in itertools.izip(indices, prices):
+            self.prices[idx] = price
+
+    def optimize(self, kind, items, window, matches):
+        """
+        Run `optimize_charstring` on the glyphs (kind "glyphs") or the
+        candidates (kind "substrings") at the indices `items` and pack
+        the results into an array of ints and one of market costs.
 
+        For each item the int array holds the number of subr calls, then
+        the (position, list_idx) of each call, then if matches is True
+        the number of matched candidates followed by their list_idx's.
+        """
+
+        packed = array.array("i")
+        costs = array.array("d")
+        pool = self.pool
+        offset = self.offset
+        for idx in items:
+            if kind == "glyphs":
+                charstring = pool[offset[idx]:offset[idx + 1]]
+                skip_idx = None
+            else:
+                start, length = self.spans[2 * idx], self.spans[2 * idx + 1]
+                charstring = pool[start:start + length]
+                skip_idx = idx
+            result = optimize_charstring(charstring,
+                                         self.cost_map,
+                                         self.substr_trie,
+                                         self.verbose,
+                                         window,
+                                         matches,
+                                         skip_idx)
+            packed.append(len(result["encoding"]))
+            for pos, substr in result["encoding"]:
+                packed.append(pos)
+                packed.append(substr)
+            if matches:
+                packed.append(len(result["matches"]))
+                packed.extend(result["matches"])
+            costs.append(result["market_cost"])
+        return packed, costs
+
+    def estimate_cost(self, kind, idx, window):
+        """Estimate the relative cost of optimizing an item: the DP tries
+        at most window + 1 encodings from each position"""
+
+        if kind == "glyphs":
+            length = self.offset[idx + 1] - self.offset[idx]
+        else:
+            length = self.spans[2 * idx + 1]
+        return length * min(length, window + 1)
+
+def unpack_results(packed, costs, matches):
+    """Turn the arrays from `MarketData.optimize` back into a list of
+    results like those of `optimize_charstring`"""
+
+    results = []
+    pos = 0
+    for market_cost in costs:
+        count = packed[pos]
+        encoding = zip(packed[pos + 1:pos + 1 + 2 * count:2],
+                       packed[pos + 2:pos + 2 + 2 * count:2])
+        pos += 1 + 2 * count
+        result = {"encoding": encoding, "market_cost": market_cost}
+        if matches:
+            count = packed[pos]
+            result["matches"] = packed[pos + 1:pos + 1 + count]
+            pos += 1 + count
+        results.append(result)
+    return results
+
+def market_worker(tasks, results):
+    """Main loop of a MarketPool worker process. Every result is tagged
+    with the generation of the batch of work it belongs to."""
+
+    market = None
+    while True:
+        task = tasks.get()
+        if task == None:
+            break
+        if task[0] == "market":
+            generation = task[1]
+            try:
+                market = MarketData.attach(*task[2:])
+                results.put((generation, None, None, None, 0.0, None))
+            except Exception:
+                market = None
+                results.put((generation, None, None, None, 0.0,
+                             traceback.format_exc()))
+        elif task[0] == "prices":
+            market.set_prices(array.array("I", task[1]), array.array("d", task[2]))
+        else:
+            generation, chunk_id, kind, items, window, matches = task
+            start_time = time.time()
+            try:
+                packed, costs = market.optimize(kind, array.array("i", items),
+                                                window, matches)
+                results.put((generation, chunk_id, packed.tostring(),
+                             costs.tostring(), time.time() - start_time, None))
+            except Exception:
+                results.put((generation, chunk_id, None, None, None,
+                             traceback.format_exc()))
+
+def topological_order(roots, callees):
+    """
+    Return the nodes of an acyclic call graph that are reachable from
+    `roots`, with every node before the nodes it calls. callees(node)
+    gives the nodes called by node. Each node is visited once, without
+    recursion, however much the graph shares or nests.
+    """
+
+    order = []
+    visited = set()
+    for root in roots:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(callees(root)))]
+        while stack:
+            node, it = stack[-1]
+            for callee in it:
+                if callee not in visited:
+                    visited.add(callee)
+                    stack.append((callee, iter(callees(callee))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    order.reverse()
+    return order
+
+def partition_work(costs, nparts):
+    """Split the work items with estimated `costs` into at most nparts
+    lists of item indices with about equal total cost, by handing out
+    the costliest items first, each to the least loaded part"""
+
+    parts = [(0, i, []) for i in range(min(nparts, len(costs)))]
+    for idx in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+        load, i, part = heapq.heappop(parts)
+        part.append(idx)
+        heapq.heappush(parts, (load + costs[idx], i, part))
+    return [part for load, i, part in sorted(parts, reverse=True)]
+
+class MarketPool(object):
+    """
+    A set of worker processes running the DP of `iterative_encode`.
+    It can outlive a Compreffor, so that one pool serves every font of
+    a batch: the workers attach to each font's MarketData once, in
+    `load_market`, then each round only the prices that changed are
+    sent to them.
+    Call `close` and `join` when done with it. With processes=0, all
+    the work is done in the calling process instead.
+
+    Work is split by estimated DP cost rather than item count, so that
+    a few very long charstrings don't all end up in one chunk. The time
+    each worker spent optimizing since `load_market` is in busy_times.
+
+    Each batch of work sent to the workers is a new generation, and
+    results left over from an earlier batch that was abandoned on an
+    error are dropped rather than taken for those of the current one.
+    If a worker exits, the pool is broken: every worker is terminated,
+    since the dead one may have held a queue lock, and any further
+    work raises RuntimeError.
+    """
+
+    # seconds to wait for a result before checking the workers are alive
+    POLL_INTERVAL = 1.0
+    # seconds `join` waits for each worker before terminating it
+    JOIN_TIMEOUT = 10.0
+
+    def __init__(self, processes=None):
+        if processes == None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.generation = 0
+        self.broken = False
+        self.market = None
+        self.sent_prices = None
+        self.busy_times = []
+        self.workers = []
+        self.task_queues = []
+        self.results = multiprocessing.Queue()
+        for _ in range(processes):
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=market_worker,
+                                             args=(tasks, self.results))
+            worker.daemon = True
+            worker.start()
+            self.task_queues.append(tasks)
+            self.workers.append(worker)
+
+    def load_market(self, market):
+        """Make market (a MarketData) the one the workers optimize in"""
+
+        self.check_broken()
+        self.market = market
+        # what the workers start from, before `update_prices`
+        self.sent_prices = array.array("d", [-1]) * len(market.prices)
+        self.busy_times = [0.0 for _ in range(max(len(self.workers), 1))]
+        if not self.workers:
+            return
+
+        self.generation += 1
+        path, lengths = market.share()
+        try:
+            for tasks in self.task_queues:
+                tasks.put(("market", self.generation, path, lengths,
+                           market.verbose))
+            for _ in self.workers:
+                self.next_result()
+        finally:
+            os.remove(path)
+
+    def update_prices(self):
+        """Send the workers the prices of self.market that changed"""
+
+        indices = array.array("I")
+        prices = array.array("d")
+        for idx, price in enumerate(self.market.prices):
+            if price != self.sent_prices[idx]:
+                indices.append(idx)
+                prices.append(price)
+                self.sent_prices[idx] = price
+        for tasks in self.task_queues:
+            tasks.put(("prices", indices.tostring(), prices.tostring()))
+
+    def optimize(self, kind, items, nchunks, window, matches=False):
+        """Optimize the glyphs or candidates at indices `items` (see
+        `MarketData.optimize`) in about nchunks chunks of equal estimated
+        cost, and return their results in order"""
+
+        if not self.workers:
+            start_time = time.time()
+            packed, costs = self.market.optimize(kind, items, window, matches)
+            self.busy_times[0] += time.time() - start_time
+            return unpack_results(packed, costs, matches)
+
+        self.check_broken()
+        self.update_prices()
+
+        # costliest chunks first, each to the least loaded worker
+        costs = [self.market.estimate_cost(kind, idx, window) for idx in items]
+        chunks = partition_work(costs, max(nchunks, len(self.workers)))
+        chunk_workers = partition_work([sum(costs[i] for i in chunk) for chunk in chunks],
+                                       len(self.workers))
+        worker_of = {}
+        for worker_idx, chunk_ids in enumerate(chunk_workers):
+            for chunk_id in chunk_ids:
+                worker_of[chunk_id] = worker_idx
+        self.generation += 1
+        for chunk_id, chunk in enumerate(chunks):
+            self.task_queues[worker_of[chunk_id]].put((self.generation,
+                    chunk_id, kind,
+                    array.array("i", [items[i] for i in chunk]).tostring(),
+                    window, matches))
+
+        results = [None for _ in items]
+        for _ in chunks:
+            chunk_id, packed, costs, busy_time = self.next_result()
+            self.busy_times[worker_of[chunk_id]] += busy_time
+            chunk_results = unpack_results(array.array("i", packed),
+                                           array.array("d", costs),
+                                           matches)
+            for i, result in zip(chunks[chunk_id], chunk_results):
+                results[i] = result
+        return results
+
+    def next_result(self):
+        """Return the (chunk_id, packed, costs, busy_time) of the next
+        result of the current generation. Raise RuntimeError if a worker
+        failed or exited."""
+
+        while True:
+            try:
+                result = self.results.get(timeout=self.POLL_INTERVAL)
+            except Queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        exitcode = worker.exitcode
+                        self.terminate()
+                        raise RuntimeError("market worker exited with code %s"
+                                           % exitcode)
+                continue
+            if result[0] != self.generation:
+                continue
+            if result[5] != None:
+                raise RuntimeError("market worker failed:\n%s" % result[5])
+            return result[1:5]
+
+    def check_broken(self):
+        """Raise RuntimeError if a worker of the pool exited"""
+
+        if self.broken:
+            raise RuntimeError("market pool is broken: a worker exited")
+
+    def terminate(self):
+        """Mark the pool broken and kill every worker"""
+
+        self.broken = True
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for tasks in self.task_queues:
+            tasks.cancel_join_thread()
+
+    def close(self):
+        """Let the workers exit once they are done"""
+
+        if self.broken:
+            return
+        for tasks in self.task_queues:
+            tasks.put(None)
+
+    def join(self):
+        """Wait for the workers to exit, after `close`. Terminate any
+        that is still running after JOIN_TIMEOUT seconds."""
+
+        for worker in self.workers:
+            worker.join(self.JOIN_TIMEOUT)
+            if worker.is_alive():
+                self.terminate()
+                worker.join()
 
 def human_size(num):
     """Return a number of bytes in human-readable units"""
@@ -1062,10 +2344,19 @@ def main(filename=None, comp_fname=None, test=False, decompress=False,
                 test_call_depth(out_name)
 
         if recursive:
-            for root, dirs, files in os.walk(filename):
-                for fname in files:
-                    if os.path.splitext(fname)[1] == '.otf':
-                        handle_font(fname)
+            if not comp_kwargs.get("single_process"):
+                # share one set of workers between all fonts
+                processes = comp_kwargs.get("processes") or Compreffor.PROCESSES
+                comp_kwargs["pool"] = MarketPool(processes=processes)
+            try:
+                for root, dirs, files in os.walk(filename):
+                    for fname in files:
+                        if os.path.splitext(fname)[1] == '.otf':
+                            handle_font(fname)
+            finally:
+                if comp_kwargs.get("pool") != None:
+                    comp_kwargs["pool"].close()
+                    comp_kwargs["pool"].join()
         else:
             handle_font(filename)
 
@@ -1101,11 +2392,15 @@ if __name__ == "__main__":
                         default=False)
     parser.add_argument("--chunkratio", required=False, type=float,
                         dest="chunk_ratio",
-                        help="0-1, specify the percentage size of the"
-                             " job chunks used for parallel processing")
+                        help="0-1, split each round's work into about"
+                             " 1 / chunkratio chunks of equal estimated"
+                             " cost for parallel processing")
     parser.add_argument("-n", "--nrounds", required=False, type=int,
                         help="the number of iterations to run the algorithm"
                              " (defaults to 4)")
+    parser.add_argument("--convergence", required=False, type=float,
+                        help="stop iterating early once the market changes by"
+                             " less than this fraction between rounds")
     parser.add_argument("--disable-parallel", required=False, action="store_true",
                         dest="single_process", help="perform operation serially")
     parser.add_argument("-p", "--nprocesses", required=False, type=int,
@@ -1115,6 +2410,25 @@ if __name__ == "__main__":
                         dest="nsubrs_limit", help="limit to the number of "
                                                   " subroutines per INDEX"
                                                   " (defaults to 64K)")
+    parser.add_argument("--maxcandidates", required=False, type=int,
+                        dest="max_candidates", help="limit to the number of "
+                                                    "candidate subroutines "
+                                                    "considered, keeping those "
+                                                    "with the best saving")
+    parser.add_argument("--finder", required=False, choices=sorted(FINDERS),
+                        help="the engine used to find candidate subroutines"
+                             " (defaults to suffix)")
+    parser.add_argument("--maxlength", required=False, type=int,
+                        dest="max_subr_length", help="limit to the number of "
+                                                     "tokens in a candidate "
+                                                     "subroutine")
+    parser.add_argument("--no-incremental", required=False, action="store_false",
+                        dest="incremental", default=None,
+                        help="re-optimize every glyph in every round")
+    parser.add_argument("--epsilon", required=False, type=float,
+                        dest="price_epsilon", help="only re-optimize glyphs "
+                                                   "affected by candidate price "
+                                                   "moves larger than this")
     parser.add_argument('--generatecff', required=False, action='store_true',
                         dest='generate_cff', default=False)
 
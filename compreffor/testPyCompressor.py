@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import unittest, random, sys
+import unittest, random, sys, os
 import pyCompressor
 from fontTools.ttLib import TTFont
 from testDummy import DummyGlyphSet
@@ -55,6 +55,124 @@ class TestCffCompressor(unittest.TestCase):
             self.assertTrue(any(cs[1].length == expected_subr_length for cs in glyph_enc))
 
 
+    def test_iterative_encode_incremental(self):
+        """Check incremental rounds give the same encodings as full ones"""
+
+        pieces = [tuple(random.randint(0, 100) for _ in range(random.randint(2, 8)))
+                  for _ in range(6)]
+        glyph_set = DummyGlyphSet()
+        for i in range(30):
+            glyph_set[i] = sum((random.choice(pieces) for _ in range(random.randint(1, 6))), ())
+
+        def encode(incremental):
+            compreffor = pyCompressor.Compreffor(None, single_process=True,
+                                                 incremental=incremental)
+            ans = compreffor.iterative_encode(DummyGlyphSet(glyph_set))
+            return dict((k, [(pos, s.value()) for pos, s in enc])
+                        for k, enc in ans["glyph_encodings"].iteritems())
+
+        self.assertEqual(encode(False), encode(True))
+
+    def test_iterative_encode_convergence(self):
+        """Check the market stops early once it converges"""
+
+        compreffor = pyCompressor.Compreffor(None, test_mode=True, single_process=True,
+                                             nrounds=10, convergence=0.01)
+        ans = compreffor.iterative_encode(self.glyph_set)
+
+        self.assertTrue(2 <= ans["nrounds"] < 10)
+
+    def test_market_converged(self):
+        """Check each convergence criterion on its own"""
+
+        a, b, c = object(), object(), object()
+
+        self.assertTrue(pyCompressor.Compreffor.market_converged(
+                            10, 20, {a: 1, b: 2}, {a: 3, b: 1}, 0.01))
+        self.assertFalse(pyCompressor.Compreffor.market_converged(
+                            10, 20, {a: 1, b: 2}, {a: 3, c: 1}, 0.01))
+        self.assertTrue(pyCompressor.Compreffor.market_converged(
+                            100, 100.5, {a: 1, b: 2}, {a: 3, c: 1}, 0.01))
+        self.assertTrue(pyCompressor.Compreffor.market_converged(
+                            10, 20, {a: 100, b: 1}, {a: 100, c: 1}, 0.02))
+
+    def test_market_pool(self):
+        """Check one MarketPool gives the same encodings across fonts"""
+
+        def encode(glyph_set, **kwargs):
+            compreffor = pyCompressor.Compreffor(None, test_mode=True, **kwargs)
+            ans = compreffor.iterative_encode(DummyGlyphSet(glyph_set))
+            return dict((k, [(pos, s.value()) for pos, s in enc])
+                        for k, enc in ans["glyph_encodings"].iteritems())
+
+        pool = pyCompressor.MarketPool(processes=2)
+        for glyph_set in (self.glyph_set, self.rand_gs):
+            self.assertEqual(encode(glyph_set, pool=pool),
+                             encode(glyph_set, single_process=True))
+        pool.close()
+        pool.join()
+
+        self.assertFalse(any(worker.is_alive() for worker in pool.workers))
+
+    def test_market_pool_errors(self):
+        """Check a MarketPool drops the results of a failed batch and
+        breaks when a worker exits"""
+
+        def market(glyphs):
+            data = pyCompressor.CharstringPool()
+            for glyph in glyphs:
+                data.append(glyph)
+            spans = [0, 2, 1, 2]
+            market = pyCompressor.MarketData(data.pool, data.offset, [1] * 100, spans)
+            market.set_prices([0, 1], [1.5, 1.0])
+            return market
+
+        # 99 makes a worker raise, 98 makes it exit before it touches the
+        # results queue, so that it can't die holding the queue's lock
+        optimize_charstring = pyCompressor.optimize_charstring
+        def failing_optimize(charstring, *args):
+            if 99 in list(charstring):
+                raise ValueError("bad charstring")
+            if 98 in list(charstring):
+                os._exit(1)
+            return optimize_charstring(charstring, *args)
+
+        good = market([(1, 2, 3, 1, 2), (2, 3, 4), (1, 2, 3, 2, 3), (4, 1, 2), (98, 1, 2)])
+        bad = market([(1, 2, 99), (2, 3, 4), (1, 2, 3, 2, 3), (4, 1, 2)])
+        inline = pyCompressor.MarketPool(processes=0)
+        inline.load_market(good)
+        expected = inline.optimize("glyphs", range(4), 4, 3, True)
+
+        pyCompressor.optimize_charstring = failing_optimize
+        try:
+            pool = pyCompressor.MarketPool(processes=2)
+        finally:
+            pyCompressor.optimize_charstring = optimize_charstring
+        pool.POLL_INTERVAL = 0.1
+        try:
+            pool.load_market(bad)
+            self.assertRaises(RuntimeError, pool.optimize, "glyphs", range(4), 4, 3, True)
+            pool.load_market(good)
+            self.assertEqual(pool.optimize("glyphs", range(4), 4, 3, True), expected)
+
+            self.assertRaises(RuntimeError, pool.optimize, "glyphs", [4], 1, 3, True)
+            self.assertTrue(pool.broken)
+            self.assertRaises(RuntimeError, pool.optimize, "glyphs", range(4), 4, 3, True)
+            self.assertRaises(RuntimeError, pool.load_market, good)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_partition_work(self):
+        """Check work is balanced by cost, not by count"""
+
+        costs = [100, 1, 1, 1, 50, 50, 1]
+        parts = pyCompressor.partition_work(costs, 2)
+
+        self.assertEqual(sorted(sum(parts, [])), range(7))
+        self.assertEqual([sum(costs[i] for i in part) for part in parts], [102, 102])
+        self.assertEqual(pyCompressor.partition_work([5, 3], 4), [[0], [1]])
+
     def test_get_substrings_all(self):
         """Test get_substrings without restrictions"""
 
@@ -73,17 +191,63 @@ class TestCffCompressor(unittest.TestCase):
             self.assertTrue(substr.freq >= 2)
             self.assertTrue(substr.subr_saving() > 0)
 
+    def test_get_substrings_max_candidates(self):
+        """Check capping candidates keeps the ones with the best savings"""
+
+        full = [s.value() for s in self.random_sf.get_substrings(0, False)]
+        capped = [s.value() for s in self.random_sf.get_substrings(0, False,
+                                                                   max_candidates=5)]
+
+        self.assertEqual(capped, full[:5])
+
+    def test_candidate_finder_abstract(self):
+        """Check only the concrete finders can be constructed"""
+
+        self.assertRaises(TypeError, pyCompressor.CandidateFinder, self.glyph_set)
+        for finder in pyCompressor.FINDERS.values():
+            self.assertTrue(issubclass(finder, pyCompressor.CandidateFinder))
+            finder(self.glyph_set)
+
+    def test_moveto_finder(self):
+        """Check MovetoSubstringFinder finds repeated whole contours"""
+
+        contour = (3, 4, 'rlineto', 5, 6, 'rlineto', 7, 'hlineto')
+        glyph_set = DummyGlyphSet({'a': (1, 2, 'rmoveto') + contour + (8, 9, 'rmoveto', 'endchar'),
+                                   'b': (5, 'hmoveto') + contour + (1, 'vmoveto', 'endchar')})
+        finder = pyCompressor.MovetoSubstringFinder(glyph_set)
+
+        ans = [tuple(finder.rev_keymap[t] for t in s.value())
+               for s in finder.get_substrings(check_positive=False)]
+
+        self.assertEqual(ans, [contour])
+
+    def test_iterative_encode_finder(self):
+        """Check Compreffor uses the finder it is given"""
+
+        calls = []
+        class RecordingFinder(pyCompressor.SubstringFinder):
+            __slots__ = []
+            def get_substrings(self, *args, **kwargs):
+                calls.append(args)
+                return super(RecordingFinder, self).get_substrings(*args, **kwargs)
+
+        compreffor = pyCompressor.Compreffor(None, test_mode=True, finder=RecordingFinder)
+        ans = compreffor.iterative_encode(self.glyph_set)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(ans["glyph_encodings"]), 3)
+
     def test_get_suffixes(self):
         """Test the results of suffix array construction."""
 
-        ans = self.short_sf.get_suffixes()
+        ans = [self.short_sf.data.location(pos) for pos in self.short_sf.get_suffixes()]
 
         self.assertEqual(ans, [(0, 0), (1, 1), (0, 1), (0, 2), (1, 0), (1, 2)])
 
     def test_get_suffixes_random(self):
         """Check suffix array invariants on random input"""
 
-        ans = self.random_sf.get_suffixes()
+        ans = [self.random_sf.data.location(pos) for pos in self.random_sf.get_suffixes()]
 
         # check there are the right number of suffixes
         expected_num = sum([len(chstring) for chstring in self.rand_gs.values()])
@@ -97,12 +261,200 @@ class TestCffCompressor(unittest.TestCase):
             current = self.random_sf.data[glyph_idx][tok_idx:]
             self.assertTrue(last <= current)
 
+    def test_get_suffixes_sais(self):
+        """Check SA-IS gives the same suffix order as the Python sort"""
+
+        glyph_set = DummyGlyphSet(self.rand_gs)
+        glyph_set['dup'] = self.rand_gs[0].program
+        glyph_set['prefix'] = self.rand_gs[0].program[:2]
+        glyph_set['empty'] = ()
+
+        sort_sf = pyCompressor.SubstringFinder(glyph_set,
+                        suffix_method=pyCompressor.SuffixMethods.Sort)
+        sais_sf = pyCompressor.SubstringFinder(glyph_set,
+                        suffix_method=pyCompressor.SuffixMethods.SAIS)
+
+        self.assertEqual(sais_sf.get_suffixes(), sort_sf.get_suffixes())
+
+    def test_sais(self):
+        """Test suffix array construction on a plain string"""
+
+        text = [ord(c) - ord('a') + 1 for c in "mississippi"] + [0]
+
+        self.assertEqual(pyCompressor.sais(text, 27),
+                         [11, 10, 7, 4, 1, 0, 9, 8, 6, 3, 5, 2])
+
     def test_get_lcp(self):
         """Test the lcp array generation"""
 
         expected = [0, 6, 5, 0, 5, 4, 0, 4, 3, 0, 3, 2, 0, 2, 1, 0, 1, 0, 0, 0, 0]
 
-        self.assertEqual(self.sf.get_lcp(), expected)
+        self.sf.lcp_method = pyCompressor.LCPMethods.Kasai
+
+        self.assertEqual(list(self.sf.get_lcp()), expected)
+
+    def test_get_lcp_chunked(self):
+        """Check the chunked lcp array matches the reference Kasai one"""
+
+        for sf in (self.sf, self.short_sf, self.random_sf):
+            sf.get_suffixes()
+            self.assertEqual(sf.chunked_lcp(), sf.kasai_lcp())
+
+    def test_charstring_pool(self):
+        """Check the flat pool lays out glyphs contiguously"""
+
+        pool = pyCompressor.CharstringPool()
+        pool.append((3, 4))
+        pool.append(())
+        pool.append((5, 6, 7))
+
+        self.assertEqual(list(pool.pool), [3, 4, 5, 6, 7])
+        self.assertEqual(list(pool.offset), [0, 2, 2, 5])
+        self.assertEqual(list(pool.rev), [0, 0, 2, 2, 2])
+        self.assertEqual(list(pool), [(3, 4), (), (5, 6, 7)])
+        self.assertEqual(pool.location(3), (2, 1))
+        self.assertEqual(pool.substring(2, 1, 2), (6, 7))
+
+    def test_charstring_pool_span_hash(self):
+        """Check equal spans hash the same wherever they are"""
+
+        pool = pyCompressor.CharstringPool()
+        pool.append((1, 2, 3, 1, 2))
+        pool.append((0, 1, 2))
+
+        # only hashed once a span is
+        self.assertEqual(pool.hashes, None)
+        self.assertEqual(pool.span_hash(0, 2), pool.span_hash(3, 2))
+        self.assertEqual(pool.span_hash(0, 2), pool.span_hash(6, 2))
+        self.assertNotEqual(pool.span_hash(0, 2), pool.span_hash(1, 2))
+        self.assertNotEqual(pool.span_hash(0, 2), pool.span_hash(5, 2))
+        self.assertTrue(pool.spans_equal(0, 6, 2))
+        self.assertFalse(pool.spans_equal(0, 5, 2))
+
+    def test_substring_trie(self):
+        """Check entries are only found for whole substrings"""
+
+        trie = pyCompressor.SubstringTrie(10)
+        trie.add((1, 2, 3), 0)
+        trie.add((1, 2), 1)
+
+        self.assertEqual(trie.get((1, 2, 3)), 0)
+        self.assertEqual(trie.get((1, 2)), 1)
+        self.assertEqual(trie.get((1,)), None)
+        self.assertEqual(trie.get((2, 3)), None)
+
+    def test_candidate_table(self):
+        """Check the table's columns agree with the CandidateSubr objects"""
+
+        substrings = self.random_sf.get_substrings(min_freq=0, check_positive=False)
+        table = pyCompressor.CandidateTable(substrings)
+        rows = pyCompressor.np.arange(len(table))
+        for i, substr in enumerate(substrings):
+            substr._usages = i % 4
+            table.encodings[i] = []
+        table.usages[:] = [i % 4 for i in rows]
+        table.encodings[0] = [(0, 1), (2, 1)]
+        self.assertEqual(list(table.subr_saving(rows)),
+                         [s.subr_saving(use_usages=True) for s in substrings])
+
+        table.count_usages(rows[:1], [[(0, 2)], [(1, 1)]])
+        self.assertEqual(list(table.usages[:3]), [0, 3, 1])
+        self.assertEqual(table.materialize(rows[1:2])[0]._usages, 3)
+
+    def test_optimize_charstring(self):
+        """Check the DP picks the cheapest substrings"""
+
+        cost_map = [1] * 10
+        trie = pyCompressor.SubstringTrie(len(cost_map), [1.5, 1.0, 3.0, -1])
+        trie.add((1, 2, 3), 0)
+        trie.add((4, 5), 1)
+        trie.add((5, 6), 2)
+        trie.add((6, 1), 3) # not in the market
+
+        result = pyCompressor.optimize_charstring((1, 2, 3, 4, 5, 6, 1, 2, 3), cost_map, trie, False)
+        self.assertEqual(result["encoding"], [(0, 0), (3, 1), (6, 0)])
+        self.assertEqual(result["market_cost"], 5.0)
+
+        # a substring must not be encoded with itself
+        result = pyCompressor.optimize_charstring((1, 2, 3), cost_map, trie, False,
+                                                  skip_idx=0)
+        self.assertEqual(result["encoding"], [])
+        self.assertEqual(result["market_cost"], 3)
+
+    def test_optimize_charstring_window(self):
+        """Check the windowed DP gives the same result as the full one"""
+
+        substrings = self.random_sf.get_substrings(min_freq=2, check_positive=False)
+        cost_map = self.random_sf.cost_map
+        prices = [random.uniform(0, len(substr)) for substr in substrings]
+        trie = pyCompressor.SubstringTrie(len(cost_map), prices)
+        for idx, substr in enumerate(substrings):
+            trie.add(substr.value(), idx)
+
+        for charstring in self.random_sf.data:
+            full = pyCompressor.optimize_charstring(charstring, cost_map, trie, False)
+            windowed = pyCompressor.optimize_charstring(charstring, cost_map, trie, False,
+                                                        window=trie.max_length)
+            self.assertEqual(full, windowed)
+
+    def test_get_substrings_max_length(self):
+        """Check no substrings longer than max_length are returned"""
+
+        substrings = self.sf.get_substrings(min_freq=0, check_positive=False, max_length=3)
+        self.assertTrue(substrings)
+        self.assertTrue(all(len(s) <= 3 for s in substrings))
+
+    def test_insert_by_usage(self):
+        """Check subrs stay sorted by usage, in order of insertion on ties"""
+
+        subrs = []
+        for i in range(300):
+            subr = pyCompressor.CandidateSubr(1, (0, i))
+            subr._usages = random.randint(0, 20)
+            pyCompressor.Compreffor.insert_by_usage(subr, subrs)
+        expected = sorted(subrs, key=lambda s: s.location)
+        expected.sort(key=lambda s: s.usages(), reverse=True)
+
+        self.assertEqual(subrs, expected)
+
+    def test_calc_nesting(self):
+        """Check call depths look through flattened subrs, even on
+        chains deeper than the recursion limit"""
+
+        chain = [pyCompressor.CandidateSubr(1, (0, i)) for i in range(3000)]
+        for caller, callee in zip(chain, chain[1:]):
+            caller._encoding = [(0, callee)]
+        chain[-1]._encoding = []
+        chain[1]._flatten = True
+        chain[2]._encoding.append((1, chain[-1]))
+
+        pyCompressor.Compreffor.calc_nesting([chain[0], chain[2]])
+
+        self.assertEqual(chain[0]._max_call_depth, 1)
+        self.assertFalse(hasattr(chain[1], "_max_call_depth"))
+        self.assertEqual(chain[2]._max_call_depth, 2)
+        self.assertEqual(chain[-1]._max_call_depth, 2999)
+
+    def test_real_costs(self):
+        """Check the real cost memo agrees with real_cost"""
+
+        chstrings = [tuple(range(12))]
+        cost_map = [1] * 12
+        subrs = [pyCompressor.CandidateSubr(l, (0, 0), 2, chstrings, cost_map)
+                 for l in (2, 4, 8, 12)]
+        subrs[0]._encoding = []
+        subrs[1]._encoding = [(0, subrs[0])]
+        subrs[2]._encoding = [(0, subrs[1]), (4, subrs[0])]
+        subrs[3]._encoding = [(0, subrs[2]), (8, subrs[1])]
+        subrs[1]._flatten = True
+        subrs[2]._flatten = True
+
+        memo = pyCompressor.Compreffor.real_costs(subrs[3:])
+
+        self.assertEqual(memo[subrs[3]], subrs[3].real_cost())
+        self.assertEqual(subrs[3].subr_saving(true_cost=True, memo=memo),
+                         subrs[3].subr_saving(true_cost=True))
+        self.assertNotIn(subrs[0], memo)
 
     def test_human_size(self):
         """Test the human_size function for various numbers of bytes"""
@@ -161,6 +513,23 @@ class TestCffCompressor(unittest.TestCase):
 
         self.assertEqual(program, [7, 5, "callgsubr", 8, 21, "callgsubr"])
 
+    def test_encode_program(self):
+        """Test encode_program with hintmasks, a call and a flattened subr"""
+
+        program = [7, 'hintmask', 2, 10, 4, 'cntrmask', 8, 7, 0]
+        substr = pyCompressor.CandidateSubr(2, (0, 1))
+        substr._position = 5
+        substr._global = True
+        flat = pyCompressor.CandidateSubr(2, (0, 4))
+        flat._flatten = True
+        flat._program = ['hintmask', 8, 7]
+        encoding = [(1, substr), (4, flat)]
+
+        ans = self.empty_compreffor.encode_program(program, encoding, 0, [0], 0)
+
+        self.assertEqual(ans, [7, 5, "callgsubr", 4, 'hintmask', 8, 7, 0])
+        self.assertEqual(program, [7, 'hintmask', 2, 10, 4, 'cntrmask', 8, 7, 0])
+
     # TODO: make this test actually work
     def test_multiple_nested_subr_calls(self):
         """Test to make sure we can handle nested subrs. This is really just
@@ -306,52 +675,48 @@ def check_cff_call_depth(cff):
 
     td = cff.topDictIndex[0]
 
-    class track_info: pass
-
-    track_info.max_for_all = 0
-
     gsubrs = cff.GlobalSubrs
     gbias = psCharStrings.calcSubrBias(gsubrs)
 
-    def follow_program(program, depth, subrs):
+    # a node is a charstring or subr with the local subrs its calls use
+    called_by = {}
+    def callees(node):
+        if node in called_by:
+            return called_by[node]
+        program, subrs = node[0].program, node[1]
         bias = psCharStrings.calcSubrBias(subrs)
 
+        called = []
         if len(program) > 0:
             last = program[0]
             for tok in program[1:]:
                 if tok == "callsubr":
                     assert type(last) == int
-                    next_subr = subrs[last + bias]
-                    if (not hasattr(next_subr, "_max_call_depth") or 
-                            next_subr._max_call_depth < depth + 1):
-                        increment_subr_depth(next_subr, depth + 1, subrs)
+                    called.append((subrs[last + bias], subrs))
                 elif tok == "callgsubr":
                     assert type(last) == int
-                    next_subr = gsubrs[last + gbias]
-                    if (not hasattr(next_subr, "_max_call_depth") or 
-                            next_subr._max_call_depth < depth + 1):
-                        increment_subr_depth(next_subr, depth + 1, subrs)
+                    called.append((gsubrs[last + gbias], subrs))
                 last = tok
         else:
             print "Compiled subr encountered"
+        called_by[node] = called
+        return called
 
-    def increment_subr_depth(subr, depth, subrs=None):
-        if not hasattr(subr, "_max_call_depth") or subr._max_call_depth < depth:
-            subr._max_call_depth = depth
-
-        if subr._max_call_depth > track_info.max_for_all:
-            track_info.max_for_all = subr._max_call_depth
-
-        program = subr.program
-        follow_program(program, depth, subrs)        
-
+    roots = []
     for cs in td.CharStrings.values():
         cs.decompile()
-        follow_program(cs.program, 0, cs.private.Subrs)
+        roots.append((cs, cs.private.Subrs))
+
+    depths = dict((root, 0) for root in roots)
+    for node in pyCompressor.topological_order(roots, callees):
+        for callee in callees(node):
+            depths[callee] = max(depths.get(callee, 0), depths[node] + 1)
+
+    max_for_all = max(depths.values()) if depths else 0
 
-    if track_info.max_for_all <= SUBR_NESTING_LIMIT:
-        print "Subroutine nesting depth ok! [max nesting depth of %d]" % track_info.max_for_all
-        return track_info.max_for_all
+    if max_for_all <= SUBR_NESTING_LIMIT:
+        print "Subroutine nesting depth ok! [max nesting depth of %d]" % max_for_all
+        return max_for_all
     else:
-        print "Subroutine nesting depth too deep :( [max nesting depth of %d]" % track_info.max_for_all
-        return track_info.max_for_all
+        print "Subroutine nesting depth too deep :( [max nesting depth of %d]" % max_for_all
+        return max_for_all
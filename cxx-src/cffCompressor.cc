@@ -19,8 +19,10 @@
 const unsigned int_size = sizeof(int_type);
 const float K = 0.1;
 const float ALPHA = 0.1;
-const unsigned NUM_THREADS = 100;
 const unsigned DEFAULT_NUM_ROUNDS = 4;
+const uint64_t HASH_BASE = 0x100000001b3ull;
+const uint64_t HASH_MIX = 0x9e3779b97f4a7c15ull;
+const uint32_t NO_SUBSTR = 0xffffffff;
 
 // token_t ============
 token_t::token_t(int_type value_) : value(value_) {}
@@ -99,13 +101,393 @@ light_substring_t::light_substring_t(uint32_t start, uint32_t len,
 // end light_substring_t =====
 
 
+// occurrence_index_t ========
+occurrence_index_t::occurrence_index_t(uint32_t poolSize,
+                                       std::vector<occurrence_t> &occurrences,
+                                       const substring_table_t &substrings)
+      : offset(poolSize + 1, 0) {
+  std::sort(occurrences.begin(), occurrences.end(),
+            [&substrings](const occurrence_t &a, const occurrence_t &b) {
+              return a.first < b.first ||
+                     (a.first == b.first &&
+                      substrings[a.second].size() < substrings[b.second].size());
+            });
+
+  substrs.reserve(occurrences.size());
+  for (const occurrence_t &occ : occurrences) {
+    ++offset[occ.first + 1];
+    substrs.push_back(occ.second);
+  }
+  for (uint32_t pos = 0; pos < poolSize; ++pos)
+    offset[pos + 1] += offset[pos];
+}
+
+void occurrence_index_t::remap(const std::vector<uint32_t> &newIds) {
+  /// renumbers the substrings by newIds in one pass, dropping those
+  /// mapped to NO_SUBSTR
+
+  uint32_t kept = 0;
+  uint32_t from = 0;
+  for (uint32_t pos = 0; pos + 1 < offset.size(); ++pos) {
+    for (; from < offset[pos + 1]; ++from) {
+      if (newIds[substrs[from]] != NO_SUBSTR)
+        substrs[kept++] = newIds[substrs[from]];
+    }
+    offset[pos + 1] = kept;
+  }
+  substrs.resize(kept);
+}
+// end occurrence_index_t ====
+
+
+// quark_table_t =============
+quark_table_t::quark_table_t() : starts(1, 0), slots(64, 0), shift(64 - 6) {}
+
+uint16_t quark_table_t::quarkFor(const unsigned char* data, unsigned len) {
+  /// the quark of the bytes [data, data + len), adding them if new
+
+  uint64_t hash = 0xcbf29ce484222325ull;  // FNV-1a
+  for (unsigned i = 0; i < len; ++i)
+    hash = (hash ^ data[i]) * HASH_BASE;
+
+  size_t mask = slots.size() - 1;
+  for (size_t idx = (hash * HASH_MIX) >> shift; slots[idx] != 0;
+          idx = (idx + 1) & mask) {
+    uint16_t q = slots[idx] - 1;
+    if (hashes[q] == hash && end(q) - begin(q) == len &&
+        std::equal(data, data + len, begin(q)))
+      return q;
+  }
+
+  assert(size() < 65536);
+  uint16_t q = size();
+  bytes.insert(bytes.end(), data, data + len);
+  starts.push_back(bytes.size());
+  hashes.push_back(hash);
+
+  // keep the table at most half full
+  if (2 * size() > slots.size()) {
+    slots.assign(2 * slots.size(), 0);
+    --shift;
+    for (unsigned other = 0; other < size(); ++other)
+      insert(other);
+  } else {
+    insert(q);
+  }
+  return q;
+}
+
+void quark_table_t::insert(uint16_t q) {
+  size_t mask = slots.size() - 1;
+  size_t idx = (hashes[q] * HASH_MIX) >> shift;
+  while (slots[idx] != 0)
+    idx = (idx + 1) & mask;
+  slots[idx] = q + 1;
+}
+// end quark_table_t =========
+
+
+// tokenizing ================
+static int_type tokenValue(const unsigned char* data, unsigned len,
+                           quark_table_t& quarks) {
+  int_type v;
+  if (len < int_size) {
+    v = len;
+    for (unsigned i = 0; i < len; ++i) {
+      v <<= 8;
+      v |= data[i];
+    }
+    v <<= 8 * (int_size - len - 1);
+  } else {
+    uint16_t q = quarks.quarkFor(data, len);
+    v = len;
+    v <<= 8;
+    v |= data[0];
+    v <<= 16;
+    v |= q;
+  }
+  return v;
+}
+
+unsigned tokenizeCharstring(const unsigned char* data, unsigned len,
+                            quark_table_t& quarks,
+                            std::vector<token_t>& tokens) {
+  /// appends the tokens of the charstring to tokens, returning how many
+
+  uint32_t numHints = 0;
+  uint32_t stackSize = 0;
+
+  unsigned nToks = 0;
+  for (unsigned csPos = 0; csPos < len; ++csPos) {
+    unsigned char first = data[csPos];
+    unsigned tokSize;
+    if (first < 28 || (first >= 29 && first < 32)) {
+      if (first < 12) {
+        // operators 1-11
+        if (first == 1 || first == 3) {
+          // hstem/vstem
+          numHints += stackSize / 2;
+        }
+        tokSize = 1;
+      } else if (first == 12) {
+        // escape (12) + addl operator code
+        tokSize = 2;
+      } else if (first < 19) {
+        // operators 13-18
+        if (first == 18) {
+          // hstemhm
+          numHints += stackSize / 2;
+        }
+        tokSize = 1;
+      } else if (first < 21) {
+        // hintmask/cntrmask (19/20)
+        if (stackSize != 0) {
+          // account for additonal vhints on stack (assuming legal program)
+          numHints += stackSize / 2;
+        }
+        tokSize = 1 + numHints / 8 + ((numHints % 8 != 0) ? 1 : 0);
+      } else if (first < 28) {
+        // operators 21-27
+        if (first == 23) {
+          // vstemhm
+          numHints += stackSize / 2;
+        }
+        tokSize = 1;
+      } else {
+        // operators 29-31
+        tokSize = 1;
+      }
+
+      stackSize = 0;
+    } else {
+      stackSize += 1;
+
+      if (first == 28) {
+        // 16-bit signed
+        tokSize = 3;
+      } else if (first < 247) {
+        // -107 to 107
+        tokSize = 1;
+      } else if (first < 251) {
+        // +108 to +1131
+        tokSize = 2;
+      } else if (first < 255) {
+        // -108 to -1131
+        tokSize = 2;
+      } else {
+        // 4-byte floating point
+        tokSize = 5;
+      }
+    }
+
+    assert(tokSize < 256);
+    tokens.push_back(token_t(tokenValue(data + csPos, tokSize, quarks)));
+    csPos += (tokSize - 1);
+
+    ++nToks;
+  }
+
+  return nToks;
+}
+// end tokenizing ============
+
+
+// thread_pool_t =============
+thread_pool_t::thread_pool_t(unsigned nThreads)
+      : tasks(NULL), nextTask(0), pending(0), stopping(false) {
+  if (nThreads > 1) {
+    for (unsigned i = 0; i < nThreads; ++i)
+      workers.push_back(std::thread(&thread_pool_t::work, this));
+  }
+}
+
+thread_pool_t::~thread_pool_t() {
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    stopping = true;
+  }
+  ready.notify_all();
+  for (std::thread& worker : workers)
+    worker.join();
+}
+
+unsigned thread_pool_t::size() const {
+  return std::max(static_cast<unsigned>(workers.size()), 1u);
+}
+
+void thread_pool_t::run(const std::vector<std::function<void()> > &_tasks) {
+  /// runs every task, returning once all are done
+
+  if (workers.empty()) {
+    for (const std::function<void()>& task : _tasks)
+      task();
+    return;
+  }
+
+  std::unique_lock<std::mutex> lock(mutex);
+  tasks = &_tasks;
+  nextTask = 0;
+  pending = _tasks.size();
+  ready.notify_all();
+  done.wait(lock, [this] { return pending == 0; });
+  tasks = NULL;
+}
+
+void thread_pool_t::work() {
+  std::unique_lock<std::mutex> lock(mutex);
+  while (true) {
+    ready.wait(lock, [this] {
+      return stopping || (tasks != NULL && nextTask < tasks->size());
+    });
+    if (stopping)
+      return;
+
+    const std::function<void()>& task = (*tasks)[nextTask++];
+    lock.unlock();
+    task();
+    lock.lock();
+    if (--pending == 0)
+      done.notify_all();
+  }
+}
+
+unsigned defaultNumThreads() {
+  // COMPREFFOR_THREADS overrides the number of cores
+  const char* env = getenv("COMPREFFOR_THREADS");
+  if (env != NULL && atoi(env) > 0)
+    return atoi(env);
+  return std::max(std::thread::hardware_concurrency(), 1u);
+}
+// end thread_pool_t =========
+
+
+// suffix array (SA-IS) ======
+const uint32_t SA_EMPTY = 0xffffffff;
+
+static void getBuckets(const uint32_t* text, uint32_t n, uint32_t alphabetSize,
+                       std::vector<uint32_t> &buckets, bool ends) {
+  buckets.assign(alphabetSize, 0);
+  for (uint32_t i = 0; i < n; ++i)
+    ++buckets[text[i]];
+  uint32_t sum = 0;
+  for (uint32_t c = 0; c < alphabetSize; ++c) {
+    sum += buckets[c];
+    buckets[c] = ends ? sum : sum - buckets[c];
+  }
+}
+
+static void induceSuffixes(const uint32_t* text, uint32_t* sa, uint32_t n,
+                           uint32_t alphabetSize,
+                           const std::vector<bool> &isS,
+                           std::vector<uint32_t> &buckets) {
+  /// fills in the L-type suffixes left to right, then the S-type
+  /// suffixes right to left, from the LMS suffixes already placed
+
+  getBuckets(text, n, alphabetSize, buckets, false);
+  for (uint32_t i = 0; i < n; ++i) {
+    if (sa[i] != SA_EMPTY && sa[i] > 0 && !isS[sa[i] - 1])
+      sa[buckets[text[sa[i] - 1]]++] = sa[i] - 1;
+  }
+  getBuckets(text, n, alphabetSize, buckets, true);
+  for (uint32_t i = n; i-- > 0;) {
+    if (sa[i] != SA_EMPTY && sa[i] > 0 && isS[sa[i] - 1])
+      sa[--buckets[text[sa[i] - 1]]] = sa[i] - 1;
+  }
+}
+
+void buildSuffixArray(const uint32_t* text, uint32_t* sa, uint32_t n,
+                      uint32_t alphabetSize) {
+  /// sorts the suffixes of text into sa in linear time; text must end
+  /// in a unique 0, and every character must be below alphabetSize
+
+  assert(n > 0 && text[n - 1] == 0);
+  if (n == 1) {
+    sa[0] = 0;
+    return;
+  }
+
+  std::vector<bool> isS(n, false);
+  isS[n - 1] = true;
+  for (uint32_t i = n - 1; i-- > 0;)
+    isS[i] = text[i] < text[i + 1] || (text[i] == text[i + 1] && isS[i + 1]);
+  auto isLMS = [&isS](uint32_t i) { return i > 0 && isS[i] && !isS[i - 1]; };
+
+  // sort the LMS substrings by inducing from their bucket ends
+  std::vector<uint32_t> buckets;
+  getBuckets(text, n, alphabetSize, buckets, true);
+  std::fill(sa, sa + n, SA_EMPTY);
+  for (uint32_t i = 1; i < n; ++i) {
+    if (isLMS(i))
+      sa[--buckets[text[i]]] = i;
+  }
+  induceSuffixes(text, sa, n, alphabetSize, isS, buckets);
+
+  // name them, equal LMS substrings getting equal names
+  uint32_t nLMS = 0;
+  for (uint32_t i = 0; i < n; ++i) {
+    if (isLMS(sa[i]))
+      sa[nLMS++] = sa[i];
+  }
+  std::fill(sa + nLMS, sa + n, SA_EMPTY);
+  uint32_t name = 0;
+  uint32_t prev = SA_EMPTY;
+  for (uint32_t i = 0; i < nLMS; ++i) {
+    uint32_t pos = sa[i];
+    bool differs = prev == SA_EMPTY;
+    for (uint32_t d = 0; !differs; ++d) {
+      if (text[pos + d] != text[prev + d] || isS[pos + d] != isS[prev + d])
+        differs = true;
+      else if (d > 0 && (isLMS(pos + d) || isLMS(prev + d)))
+        break;
+    }
+    if (differs) {
+      ++name;
+      prev = pos;
+    }
+    sa[nLMS + pos / 2] = name - 1;
+  }
+  uint32_t j = n;
+  for (uint32_t i = n; i-- > nLMS;) {
+    if (sa[i] != SA_EMPTY)
+      sa[--j] = sa[i];
+  }
+
+  // sort the LMS suffixes, recursing while their names repeat
+  uint32_t* reduced = sa + n - nLMS;
+  if (name < nLMS) {
+    buildSuffixArray(reduced, sa, nLMS, name);
+  } else {
+    for (uint32_t i = 0; i < nLMS; ++i)
+      sa[reduced[i]] = i;
+  }
+
+  // and induce the full order from them
+  j = 0;
+  for (uint32_t i = 1; i < n; ++i) {
+    if (isLMS(i))
+      reduced[j++] = i;
+  }
+  for (uint32_t i = 0; i < nLMS; ++i)
+    sa[i] = reduced[sa[i]];
+  std::fill(sa + nLMS, sa + n, SA_EMPTY);
+  getBuckets(text, n, alphabetSize, buckets, true);
+  for (uint32_t i = nLMS; i-- > 0;) {
+    uint32_t pos = sa[i];
+    sa[i] = SA_EMPTY;
+    sa[--buckets[text[pos]]] = pos;
+  }
+  induceSuffixes(text, sa, n, alphabetSize, isS, buckets);
+}
+// end suffix array ==========
+
+
 // substring_t ===============
-substring_t::substring_t(unsigned _len, unsigned _start, unsigned _freq)
-  :  pos(0), flatten(true), start(_start), len(_len), freq(_freq), _cost(0) {}
+substring_t::substring_t(unsigned _len, unsigned _start)
+  :  pos(0), flatten(true), start(_start), len(_len), _cost(0) {}
 
 substring_t::substring_t(const substring_t &other)
   :  pos(0), flatten(other.flatten), start(other.start), len(other.len),
-    freq(other.freq), _cost(0) {}
+    _cost(0) {}
 
 const_tokiter_t substring_t::begin(const charstring_pool_t &chPool) const {
   return chPool.get(start);
@@ -154,17 +536,18 @@ uint16_t substring_t::doCost(const charstring_pool_t &chPool) const {
   return sum;
 }
 
-int substring_t::subrSaving(const charstring_pool_t &chPool) {
+int substring_t::subrSaving(const charstring_pool_t &chPool, unsigned freq) {
   // XXX needs use_usages and true_cost, (and call_cost and subr_overhead params)
-  return doSubrSaving(cost(chPool));
+  return doSubrSaving(cost(chPool), freq);
 }
 
-int substring_t::subrSaving(const charstring_pool_t &chPool) const {
+int substring_t::subrSaving(const charstring_pool_t &chPool,
+                            unsigned freq) const {
   // XXX needs use_usages and true_cost, (and call_cost and subr_overhead params)
-  return doSubrSaving(cost(chPool));
+  return doSubrSaving(cost(chPool), freq);
 }
 
-int substring_t::doSubrSaving(int subCost) const {
+int substring_t::doSubrSaving(int subCost, unsigned freq) const {
   int amt = freq;
   int callCost = 5;
   int subrOverhead = 3;
@@ -191,7 +574,6 @@ substring_t& substring_t::operator=(const substring_t &other) {
   if (*this != other) {
     start = other.start;
     len = other.len;
-    freq = other.freq;
     _cost = other._cost;
   }
   return *this;
@@ -220,73 +602,81 @@ inline uint32_t substring_t::size() const {
 inline uint32_t substring_t::getStart() const {
   return start;
 }
+// end substring_t ============
 
-inline void substring_t::setAdjCost(float val) {
-  assert(val > 0);
-  adjCost = val;
-}
-
-inline void substring_t::syncPrice() {
-  price = adjCost;
-}
-
-void substring_t::updatePrice() {
-  float margCost = static_cast<float>(adjCost) / (freq + K);
-  price = margCost * ALPHA + price * (1 - ALPHA);
-}
-
-inline uint32_t substring_t::getFreq() const {
-  return freq;
-}
-
-inline void substring_t::resetFreq() {
-  freq = 0;
-}
-
-inline void substring_t::incrementFreq() {
-  ++freq;
-}
 
-inline void substring_t::increaseFreq(unsigned amt) {
-  freq += amt;
+// substring_table_t =========
+void substring_table_t::add(const substring_t &substr, uint32_t freq) {
+  substrs.push_back(substr);
+  prices.push_back(0);
+  adjCosts.push_back(0);
+  freqs.push_back(freq);
 }
 
-inline void substring_t::decrementFreq() {
-  assert(freq != 0);
-  --freq;
+int substring_table_t::subrSaving(uint32_t id,
+                                  const charstring_pool_t &chPool) {
+  return substrs[id].subrSaving(chPool, freqs[id]);
 }
 
-inline float substring_t::getPrice() const {
-  return price;
+void substring_table_t::updatePrices() {
+  for (uint32_t id = 0; id < substrs.size(); ++id) {
+    float margCost = adjCosts[id] / (freqs[id] + K);
+    prices[id] = margCost * ALPHA + prices[id] * (1 - ALPHA);
+  }
 }
 
-inline void substring_t::setPrice(float newPrice) {
-  price = newPrice;
+std::vector<uint32_t> substring_table_t::compact(
+                                      const std::vector<bool> &keep) {
+  /// drops the substrings not kept, keeping the rest in order, and
+  /// returns the new id of each old one (NO_SUBSTR if dropped)
+
+  std::vector<uint32_t> newIds(substrs.size(), NO_SUBSTR);
+  uint32_t kept = 0;
+  for (uint32_t id = 0; id < substrs.size(); ++id) {
+    if (!keep[id])
+      continue;
+    if (kept != id) {
+      substrs[kept] = substrs[id];
+      substrs[kept].flatten = substrs[id].flatten;
+      substrs[kept].encoding.swap(substrs[id].encoding);
+      prices[kept] = prices[id];
+      adjCosts[kept] = adjCosts[id];
+      freqs[kept] = freqs[id];
+    }
+    newIds[id] = kept++;
+  }
+  substrs.erase(substrs.begin() + kept, substrs.end());
+  prices.resize(kept);
+  adjCosts.resize(kept);
+  freqs.resize(kept);
+  return newIds;
 }
-// end substring_t ============
+// end substring_table_t =====
 
 
 // charstring_pool_t ==========
 charstring_pool_t::charstring_pool_t(unsigned nCharstrings)
-  : nextQuark(0), fdSelectTrivial(true), count(nCharstrings),
-    finalized(false), numRounds(DEFAULT_NUM_ROUNDS) {
+  : fdSelectTrivial(true), count(nCharstrings),
+    finalized(false), numRounds(DEFAULT_NUM_ROUNDS), maxSubrLength(0),
+    convergence(0), roundsRun(0), verbose(false), suffixSort(SUFFIX_SORT_SAIS),
+    numThreads(defaultNumThreads()) {
   pool.reserve(nCharstrings);
   offset.reserve(nCharstrings + 1);
   offset.push_back(0);
 }
 
 charstring_pool_t::charstring_pool_t(unsigned nCharstrings, int _nrounds)
-  : nextQuark(0), fdSelectTrivial(true), count(nCharstrings),
-    finalized(false), numRounds(_nrounds) {
+  : fdSelectTrivial(true), count(nCharstrings),
+    finalized(false), numRounds(_nrounds), maxSubrLength(0),
+    convergence(0), roundsRun(0), verbose(false), suffixSort(SUFFIX_SORT_SAIS),
+    numThreads(defaultNumThreads()) {
   pool.reserve(nCharstrings);
   offset.reserve(nCharstrings + 1);
   offset.push_back(0);
 }
 
-void charstring_pool_t::writeEncoding(
-                              const encoding_list& enc,
-                              const std::map<const substring_t*, uint32_t>& index,
-                              std::ostream& outFile) {
+void charstring_pool_t::writeEncoding(const encoding_list& enc,
+                                      std::ostream& outFile) {
   // write the number of subrs called
   assert(enc.size() < 128);
   outFile.put(enc.size());
@@ -295,15 +685,13 @@ void charstring_pool_t::writeEncoding(
     outFile.write(
               reinterpret_cast<const char*>(&enc_item.pos),
               sizeof(enc_item.pos));  // 4 bytes
-    auto it = index.find(enc_item.substr);
-    assert(it != index.end());
-    uint32_t subrIndex = it->second;
-    outFile.write(reinterpret_cast<const char*>(&subrIndex), 4);
+    // subrs are numbered by id
+    outFile.write(reinterpret_cast<const char*>(&enc_item.substr), 4);
   }
 }
 
 void charstring_pool_t::writeSubrs(
-              std::list<substring_t>& subrs,
+              substring_table_t& subrs,
               std::vector<encoding_list>& glyphEncodings,
               std::ostream& outFile) {
   /// write subrs
@@ -311,13 +699,9 @@ void charstring_pool_t::writeSubrs(
   uint32_t numSubrs = (uint32_t) subrs.size();
   outFile.write(reinterpret_cast<const char*>(&numSubrs), 4);
 
-  // number subrs
-  std::map<const substring_t*, uint32_t> index;
-
   // write each subr's representative glyph and offset in that charstring
-  uint32_t curIndex = 0;
-  for (const substring_t& subr : subrs) {
-    index[&subr] = curIndex++;
+  for (uint32_t id = 0; id < subrs.size(); ++id) {
+    const substring_t& subr = subrs[id];
     uint32_t glyphIdx = rev[subr.getStart()];
     uint32_t glyphOffset = subr.getStart() - offset[glyphIdx];
     uint32_t subrLength = subr.size();
@@ -326,21 +710,19 @@ void charstring_pool_t::writeSubrs(
     outFile.write(reinterpret_cast<const char*>(&subrLength), 4);
   }
 
-  // after producing `index`, write subr encodings
-  for (const substring_t& subr : subrs) {
-    writeEncoding(subr.encoding, index, outFile);
+  // write subr encodings
+  for (uint32_t id = 0; id < subrs.size(); ++id) {
+    writeEncoding(subrs[id].encoding, outFile);
   }
 
   /// write glyph encoding instructions
   for (const encoding_list& glyphEnc : glyphEncodings) {
-    writeEncoding(glyphEnc, index, outFile);
+    writeEncoding(glyphEnc, outFile);
   }
 }
 
-unsigned charstring_pool_t::packEncoding(
-                            const encoding_list& enc,
-                            const std::map<const substring_t*, uint32_t>& index,
-                            uint32_t* buffer) {
+unsigned charstring_pool_t::packEncoding(const encoding_list& enc,
+                                         uint32_t* buffer) {
   unsigned pos = 0;
 
   // write the number of subrs called
@@ -348,21 +730,18 @@ unsigned charstring_pool_t::packEncoding(
   // write each call
   for (const encoding_item& enc_item : enc) {
     buffer[pos++] = enc_item.pos;
-    auto it = index.find(enc_item.substr);
-    assert(it != index.end());
-    uint32_t subrIndex = it->second;
-    buffer[pos++] = subrIndex;
+    buffer[pos++] = enc_item.substr;
   }
 
   return pos;
 }
 
 uint32_t* charstring_pool_t::getResponse(
-              std::list<substring_t>& subrs,
+              substring_table_t& subrs,
               std::vector<encoding_list>& glyphEncodings) {
   unsigned length = 1 + subrs.size() * 3;
-  for (const substring_t& subr : subrs) {
-    length += 1 + subr.encoding.size() * 2;
+  for (uint32_t id = 0; id < subrs.size(); ++id) {
+    length += 1 + subrs[id].encoding.size() * 2;
   }
   for (const encoding_list& glyphEnc : glyphEncodings) {
     length += 1 + glyphEnc.size() * 2;
@@ -376,13 +755,9 @@ uint32_t* charstring_pool_t::getResponse(
   uint32_t numSubrs = (uint32_t) subrs.size();
   buffer[pos++] = numSubrs;
 
-  // number subrs
-  std::map<const substring_t*, uint32_t> index;
-
   // write each subr's representative glyph and offset in that charstring
-  uint32_t curIndex = 0;
-  for (const substring_t& subr : subrs) {
-    index[&subr] = curIndex++;
+  for (uint32_t id = 0; id < subrs.size(); ++id) {
+    const substring_t& subr = subrs[id];
     uint32_t glyphIdx = rev[subr.getStart()];
     uint32_t glyphOffset = subr.getStart() - offset[glyphIdx];
     uint32_t subrLength = subr.size();
@@ -391,14 +766,14 @@ uint32_t* charstring_pool_t::getResponse(
     buffer[pos++] = subrLength;
   }
 
-  // after producing `index`, write subr encodings
-  for (const substring_t& subr : subrs) {
-    pos += packEncoding(subr.encoding, index, buffer + pos);
+  // write subr encodings
+  for (uint32_t id = 0; id < subrs.size(); ++id) {
+    pos += packEncoding(subrs[id].encoding, buffer + pos);
   }
 
   /// write glyph encoding instructions
   for (const encoding_list& glyphEnc : glyphEncodings) {
-    pos += packEncoding(glyphEnc, index, buffer + pos);
+    pos += packEncoding(glyphEnc, buffer + pos);
   }
 
   return buffer;
@@ -431,178 +806,341 @@ std::vector<unsigned char> charstring_pool_t::formatInt(int num) {
 }
 
 void charstring_pool_t::subroutinize(
-              std::list<substring_t>& substrings,
+              substring_table_t& substrings,
               std::vector<encoding_list>& glyphEncodings) {  // TODO: testMode
-  std::map<light_substring_t, substring_t*> substrMap;
-
   /// set up map with initial values
-  for (substring_t &substr : substrings) {
-    substr.setAdjCost(substr.cost(*this));
-    substr.syncPrice();
-    light_substring_t key(substr.begin(*this), substr.end(*this));
-    substrMap[key] = &substr;
+  for (uint32_t id = 0; id < substrings.size(); ++id) {
+    substrings.adjCosts[id] = substrings[id].cost(*this);
+    assert(substrings.adjCosts[id] > 0);
   }
-
-  unsigned substringChunkSize = substrings.size() / NUM_THREADS + 1;
-  unsigned glyphChunkSize = count / NUM_THREADS + 1;
-  std::vector<std::future< std::vector<encoding_list> > > futures;
-  std::vector<std::thread> threads;
-
-  for (int runCount = 0; runCount < numRounds; ++runCount) {
+  substrings.prices = substrings.adjCosts;
+  std::vector<occurrence_t> occs = findOccurrences(substrings);
+  occurrence_index_t index(pool.size(), occs, substrings);
+  occs.clear();
+
+  thread_pool_t& threads = getThreads();
+  std::vector<std::function<void()> > tasks;
+  std::vector<dp_scratch_t> scratches(threads.size());
+  std::vector<encoding_span_t> glyphSpans(count);
+  std::vector<float> glyphCosts(count);
+  busyTimes.assign(threads.size(), 0);
+
+  // with a convergence threshold, numRounds is only the most to run
+  int nRounds = numRounds;
+  float lastCost = 0;
+  std::vector<uint32_t> lastUsages;
+
+  int runCount = 0;
+  for (; runCount < nRounds; ++runCount) {
     /// update market
-    for (substring_t& substr : substrings) {
-      substr.updatePrice();
-    }
+    substrings.updatePrices();
+    unsigned maxLen = 0;
+    for (uint32_t id = 0; id < substrings.size(); ++id)
+      maxLen = std::max(maxLen, substrings[id].size());
 
     /// minimize cost of substrings
-    // XXX consider redoing substringChunkSize
-    threads.clear();
-    auto curSubstr = substrings.begin();
-    for (unsigned i = 0; i < NUM_THREADS; ++i) {
-      if (i * substringChunkSize >= substrings.size())
-        break;
-
-      unsigned step = substringChunkSize;
-      if ((i + 1) * substringChunkSize > substrings.size())
-        step = substrings.size() - i * substringChunkSize;
-
-      auto start = curSubstr;
-      std::advance(curSubstr, step);
-
-      threads.push_back(std::thread(optimizeSubstrings,
-                            std::ref(substrMap),
+    // split the work by estimated DP cost, costliest first
+    std::vector<uint64_t> costs;
+    for (uint32_t id = 0; id < substrings.size(); ++id)
+      costs.push_back(estimateDPCost(substrings[id].size(), maxLen));
+    std::vector<std::vector<unsigned> > parts =
+                                      partitionWork(costs, threads.size());
+    tasks.clear();
+    for (unsigned i = 0; i < parts.size(); ++i) {
+      tasks.push_back(std::bind(optimizeSubstrings,
+                            std::cref(index),
                             std::ref(*this),
-                            start,
-                            curSubstr));
-    }
-    for (auto threadIt = threads.begin(); threadIt != threads.end(); ++threadIt) {
-      threadIt->join();
+                            std::ref(substrings),
+                            std::cref(parts[i]),
+                            maxLen,
+                            std::ref(scratches[i]),
+                            std::ref(busyTimes[i])));
     }
+    threads.run(tasks);
 
     // minimize cost of glyphstrings
-    futures.clear();
-    glyphEncodings.clear();
-    for (unsigned i = 0; i < NUM_THREADS; ++i) {
-      if (i * glyphChunkSize >= count)
-        break;
-
-      unsigned stop = (i + 1) * glyphChunkSize;
-      if (stop > count)
-        stop = count;
-
-      futures.push_back(std::async(std::launch::async,
-                            optimizeGlyphstrings,
-                            std::ref(substrMap),
+    costs.clear();
+    for (unsigned i = 0; i < count; ++i)
+      costs.push_back(estimateDPCost(offset[i + 1] - offset[i], maxLen));
+    parts = partitionWork(costs, threads.size());
+    tasks.clear();
+    for (unsigned i = 0; i < parts.size(); ++i) {
+      tasks.push_back(std::bind(optimizeGlyphstrings,
+                            std::cref(index),
                             std::ref(*this),
-                            i * glyphChunkSize,
-                            stop));
-    }
-    for (auto threadIt = futures.begin(); threadIt != futures.end(); ++threadIt) {
-      std::vector<encoding_list> res = threadIt->get();
-      glyphEncodings.insert(glyphEncodings.end(), res.begin(), res.end());
+                            std::cref(substrings),
+                            std::cref(parts[i]),
+                            maxLen,
+                            i,
+                            std::ref(scratches[i]),
+                            std::ref(glyphSpans),
+                            std::ref(glyphCosts),
+                            std::ref(busyTimes[i])));
     }
+    threads.run(tasks);
+    float marketCost = 0;
+    for (float glyphCost : glyphCosts)
+      marketCost += glyphCost;
 
     // update usages
-    for (substring_t& substr : substrings) {
-      substr.resetFreq();
+    std::fill(substrings.freqs.begin(), substrings.freqs.end(), 0);
+    for (uint32_t id = 0; id < substrings.size(); ++id) {
+      for (encoding_item& enc : substrings[id].encoding) {
+        ++substrings.freqs[enc.substr];
+      }
     }
-
-    for (substring_t& substr : substrings) {
-      for (encoding_item& enc : substr.encoding) {
-        enc.substr->incrementFreq();
+    for (const encoding_span_t& span : glyphSpans) {
+      const encoding_list& arena = scratches[span.arena].arena;
+      for (uint32_t k = span.begin; k < span.end; ++k) {
+        ++substrings.freqs[arena[k].substr];
       }
     }
-    for (encoding_list& encList : glyphEncodings) {
-      for (encoding_item& enc : encList) {
-        enc.substr->incrementFreq();
+
+    if (convergence > 0) {
+      if (runCount > 0 && marketConverged(lastCost, marketCost,
+                                          lastUsages, substrings.freqs,
+                                          convergence)) {
+        // the cutdown before the last round must be the final one
+        nRounds = std::min(nRounds, runCount + 2);
       }
+      lastCost = marketCost;
+      lastUsages = substrings.freqs;
     }
 
     /// cutdown
-    if (runCount <= numRounds - 2) {  // NOTE: python checks for testMode
-      auto substrIt = substrings.begin();
-      for (; substrIt != substrings.end();) {
-        if (substrIt->subrSaving(*this) <= 0) {
-          light_substring_t key(substrIt->begin(*this), substrIt->end(*this));
-          size_t response = substrMap.erase(key);
+    if (runCount <= nRounds - 2) {  // NOTE: python checks for testMode
+      // the heuristic may raise the frequency of substrings yet to be
+      // checked, so cut ones are only dropped once all are checked
+      std::vector<bool> keep(substrings.size(), true);
+      bool cut = false;
+      for (uint32_t id = 0; id < substrings.size(); ++id) {
+        if (substrings.subrSaving(id, *this) <= 0) {
           // heuristic:
-          for (encoding_list::iterator encItem = substrIt->encoding.begin();
-                  encItem != substrIt->encoding.end(); ++encItem) {
-            encItem->substr->increaseFreq(substrIt->getFreq() - 1);
+          for (encoding_item& encItem : substrings[id].encoding) {
+            substrings.freqs[encItem.substr] += substrings.freqs[id] - 1;
           }
 
-          substrIt = substrings.erase(substrIt);
-        } else {
-          ++substrIt;
+          keep[id] = false;
+          cut = true;
         }
       }
+
+      if (cut) {
+        std::vector<uint32_t> newIds = substrings.compact(keep);
+        index.remap(newIds);
+
+        // the encodings are all redone next round, so rather than
+        // remapping them, drop them
+        for (uint32_t id = 0; id < substrings.size(); ++id)
+          substrings[id].encoding.clear();
+
+        if (convergence > 0) {
+          // a cut substring still counts as having stopped being used,
+          // so its usage moves past the ids in use
+          std::vector<uint32_t> keptUsages(substrings.size(), 0);
+          for (uint32_t id = 0; id < newIds.size(); ++id) {
+            if (newIds[id] != NO_SUBSTR)
+              keptUsages[newIds[id]] = lastUsages[id];
+            else if (lastUsages[id] > 0)
+              keptUsages.push_back(lastUsages[id]);
+          }
+          lastUsages.swap(keptUsages);
+        }
+      }
+
+      if (convergence > 0 && runCount == nRounds - 2 && !cut) {
+        // nothing was cut, so this round's encodings are final
+        nRounds = runCount + 1;
+      }
     }
   }
+
+  roundsRun = runCount;
+  glyphEncodings.resize(count);
+  for (unsigned i = 0; i < count; ++i) {
+    const encoding_list& arena = scratches[glyphSpans[i].arena].arena;
+    glyphEncodings[i].assign(arena.begin() + glyphSpans[i].begin,
+                             arena.begin() + glyphSpans[i].end);
+  }
+  if (verbose) {
+    std::cerr << "Ran " << roundsRun << " rounds" << std::endl;
+    // each round splits the work into one partition per thread, but
+    // any thread may run any partition, so this is not per thread
+    std::cerr << "Partition busy time:";
+    for (double busyTime : busyTimes) {
+      if (busyTime > 0)
+        std::cerr << " " << busyTime << "s";
+    }
+    std::cerr << std::endl;
+  }
 }
 
-void optimizeSubstrings(std::map<light_substring_t, substring_t*> &substrMap,
+uint64_t estimateDPCost(unsigned len, unsigned maxLen) {
+  // optimizeCharstring tries at most maxLen + 1 encodings per position
+  return static_cast<uint64_t>(len) * std::min(len, maxLen + 1);
+}
+
+std::vector<std::vector<unsigned> > partitionWork(
+                                      const std::vector<uint64_t>& costs,
+                                      unsigned nParts) {
+  // hand out the costliest items first, each to the least loaded part
+  std::vector<unsigned> order(costs.size());
+  for (unsigned i = 0; i < order.size(); ++i)
+    order[i] = i;
+  std::stable_sort(order.begin(), order.end(),
+                   [&costs](unsigned a, unsigned b) {
+                     return costs[a] > costs[b];
+                   });
+
+  nParts = std::min(nParts, static_cast<unsigned>(costs.size()));
+  std::vector<std::vector<unsigned> > parts(nParts);
+  typedef std::pair<uint64_t, unsigned> load_t;
+  std::priority_queue<load_t, std::vector<load_t>, std::greater<load_t> >
+      loads;
+  for (unsigned i = 0; i < nParts; ++i)
+    loads.push(load_t(0, i));
+  for (unsigned idx : order) {
+    load_t least = loads.top();
+    loads.pop();
+    parts[least.second].push_back(idx);
+    loads.push(load_t(least.first + costs[idx], least.second));
+  }
+  return parts;
+}
+
+bool marketConverged(float lastCost, float cost,
+                     const std::vector<uint32_t>& lastUsages,
+                     const std::vector<uint32_t>& usages,
+                     float threshold) {
+  // ids past the end of either are unused there
+  unsigned change = 0;
+  unsigned total = 0;
+  bool sameUsed = true;
+  size_t nIds = std::max(lastUsages.size(), usages.size());
+  for (size_t id = 0; id < nIds; ++id) {
+    unsigned last = id < lastUsages.size() ? lastUsages[id] : 0;
+    unsigned cur = id < usages.size() ? usages[id] : 0;
+    if ((last > 0) != (cur > 0))
+      sameUsed = false;
+    change += last > cur ? last - cur : cur - last;
+    total += cur;
+  }
+
+  if (sameUsed)
+    return true;
+
+  float costChange = std::abs(cost - lastCost) / std::max(cost, 1.0f);
+  float usageChange = static_cast<float>(change) / std::max(total, 1u);
+  return costChange < threshold || usageChange < threshold;
+}
+
+void optimizeSubstrings(const occurrence_index_t &index,
                         charstring_pool_t &csPool,
-                        std::list<substring_t>::iterator begin,
-                        std::list<substring_t>::iterator end) {
-  for (auto it = begin; it != end; ++it) {
-    auto ans = optimizeCharstring(
-                    it->begin(csPool),
-                    it->size(),
-                    substrMap,
+                        substring_table_t &substrings,
+                        const std::vector<uint32_t>& ids,
+                        unsigned maxLen,
+                        dp_scratch_t& scratch,
+                        double& busyTime) {
+  auto start = std::chrono::steady_clock::now();
+  for (uint32_t id : ids) {
+    // refilled in place, keeping last round's capacity
+    substrings[id].encoding.clear();
+    float cost = optimizeCharstring(
+                    substrings[id].begin(csPool),
+                    substrings[id].size(),
+                    index,
+                    substrings,
                     csPool,
-                    true);
-    it->encoding = ans.first;
-    it->setAdjCost(ans.second);
+                    maxLen,
+                    scratch,
+                    substrings[id].encoding);
+    assert(cost > 0);
+    substrings.adjCosts[id] = cost;
   }
+  busyTime += std::chrono::duration<double>(
+                  std::chrono::steady_clock::now() - start).count();
 }
 
-std::vector<encoding_list> optimizeGlyphstrings(
-                          std::map<light_substring_t, substring_t*> &substrMap,
+void optimizeGlyphstrings(
+                          const occurrence_index_t &index,
                           charstring_pool_t &csPool,
-                          unsigned start,
-                          unsigned stop) {
-  std::vector<encoding_list> result;
-  for (unsigned i = start; i < stop; ++i) {
+                          const substring_table_t &substrings,
+                          const std::vector<unsigned>& glyphs,
+                          unsigned maxLen,
+                          uint32_t arena,
+                          dp_scratch_t& scratch,
+                          std::vector<encoding_span_t>& glyphSpans,
+                          std::vector<float>& glyphCosts,
+                          double& busyTime) {
+  auto start = std::chrono::steady_clock::now();
+  scratch.arena.clear();
+  for (unsigned i : glyphs) {
     charstring_t cs = csPool.getCharstring(i);
-    result.push_back(optimizeCharstring(
+    glyphSpans[i].arena = arena;
+    glyphSpans[i].begin = scratch.arena.size();
+    glyphCosts[i] = optimizeCharstring(
                               cs.begin,
                               cs.len,
-                              substrMap,
+                              index,
+                              substrings,
                               csPool,
-                              false)
-                        .first);
+                              maxLen,
+                              scratch,
+                              scratch.arena);
+    glyphSpans[i].end = scratch.arena.size();
   }
-  return result;
+  busyTime += std::chrono::duration<double>(
+                  std::chrono::steady_clock::now() - start).count();
 }
 
-std::pair<encoding_list, float> optimizeCharstring(
+float optimizeCharstring(
       const_tokiter_t begin, uint32_t len,
-      std::map<light_substring_t, substring_t*> &substrMap,
-      charstring_pool_t& csPool, bool isSubstring) {
-  std::vector<float> results(len + 1);
-  std::vector<int> nextEncIdx(len, -1);
-  std::vector<substring_t*> nextEncSubstr(len, NULL);
+      const occurrence_index_t &index, const substring_table_t &substrings,
+      charstring_pool_t& csPool, unsigned maxLen,
+      dp_scratch_t& scratch, encoding_list& encoding) {
+  /// appends the cheapest encoding of [begin, begin + len) to encoding,
+  /// returning its cost
+
+  uint32_t base = begin - csPool.get(0);
+  // every entry below len is written before it is read
+  if (scratch.results.size() < len + 1) {
+    scratch.results.resize(len + 1);
+    scratch.nextEncIdx.resize(len);
+    scratch.nextEncSubstr.resize(len);
+  }
+  float* results = scratch.results.data();
+  int* nextEncIdx = scratch.nextEncIdx.data();
+  uint32_t* nextEncSubstr = scratch.nextEncSubstr.data();
+  results[len] = 0;
 
   for (int i = len - 1; i >= 0; --i) {
     float minOption = -1;
     int minEncIdx = len;
-    substring_t* minEncSubstr = NULL;
+    uint32_t minEncSubstr = NO_SUBSTR;
     int curCost = 0;
 
+    // No substring is longer than maxLen, so [i, i + maxLen + 1) is
+    // always costed raw. Any longer raw run costs at least as much as
+    // that one followed by results[i + maxLen + 1], so the scan can
+    // stop there, making this O(len * maxLen).
+    unsigned stop = std::min(len, i + maxLen + 1);
+
+    // the substrings occurring at i, shortest first
+    const uint32_t* match = index.begin(base + i);
+    const uint32_t* matchEnd = index.end(base + i);
     const_tokiter_t curToken = begin + i;
-    for (unsigned j = i + 1; j <= len; ++j, ++curToken) {
+    for (unsigned j = i + 1; j <= stop; ++j, ++curToken) {
       curCost += curToken->size();
 
-      light_substring_t key(begin + i, begin + j);
-      auto entryIt = substrMap.find(key);
-      substring_t* substr;
+      uint32_t substr = NO_SUBSTR;
+      if (match != matchEnd && substrings[*match].size() == j - i)
+        substr = *match++;
       float option;
-      if (!(i == 0 && j == len) && entryIt != substrMap.end()) {
+      if (!(i == 0 && j == len) && substr != NO_SUBSTR) {
         // TODO: check to not subroutinize with yourself
-        substr = entryIt->second;
-        option = substr->getPrice() + results[j];
+        option = substrings.prices[substr] + results[j];
       } else {
-        substr = NULL;
+        substr = NO_SUBSTR;
         option = curCost + results[j];
       }
 
@@ -618,32 +1156,31 @@ std::pair<encoding_list, float> optimizeCharstring(
     nextEncSubstr[i] = minEncSubstr;
   }
 
-  encoding_list ans;
   unsigned curEncIdx = 0;
 
   while (curEncIdx < len) {
     uint16_t lastIdx = curEncIdx;
-    substring_t* curEncSubstr = nextEncSubstr[curEncIdx];
+    uint32_t curEncSubstr = nextEncSubstr[curEncIdx];
     curEncIdx = nextEncIdx[curEncIdx];
 
-    if (curEncSubstr != NULL) {
+    if (curEncSubstr != NO_SUBSTR) {
       encoding_item item;
       item.pos = lastIdx;
       item.substr = curEncSubstr;
-      ans.push_back(item);
+      encoding.push_back(item);
     }
   }
 
-  return std::pair<encoding_list, float>(ans, results[0]);
+  return results[0];
 }
 
-std::list<substring_t> charstring_pool_t::getSubstrings() {
+substring_table_t charstring_pool_t::getSubstrings() {
   if (!finalized)
     finalize();
 
   std::vector<unsigned> suffixes = generateSuffixes();
   std::vector<unsigned> lcp = generateLCP(suffixes);
-  std::list<substring_t> substrings = generateSubstrings(suffixes, lcp);
+  substring_table_t substrings = generateSubstrings(suffixes, lcp);
 
   return substrings;
 }
@@ -662,83 +1199,80 @@ charstring_t charstring_pool_t::getCharstring(unsigned idx) {
 void charstring_pool_t::addRawCharstring(unsigned char* data, unsigned len) {
   assert(!finalized);
 
-  uint32_t numHints = 0;
-  uint32_t stackSize = 0;
+  unsigned nToks = tokenizeCharstring(data, len, quarks, pool);
+  offset.push_back(offset.back() + nToks);
+}
 
-  unsigned nToks = 0;
-  for (unsigned csPos = 0; csPos < len; ++csPos) {
-    unsigned char first = data[csPos];
-    unsigned tokSize;
-    if (first < 28 || (first >= 29 && first < 32)) {
-      if (first < 12) {
-        // operators 1-11
-        if (first == 1 || first == 3) {
-          // hstem/vstem
-          numHints += stackSize / 2;
-        }
-        tokSize = 1;
-      } else if (first == 12) {
-        // escape (12) + addl operator code
-        tokSize = 2;
-      } else if (first < 19) {
-        // operators 13-18
-        if (first == 18) {
-          // hstemhm
-          numHints += stackSize / 2;
-        }
-        tokSize = 1;
-      } else if (first < 21) {
-        // hintmask/cntrmask (19/20)
-        if (stackSize != 0) {
-          // account for additonal vhints on stack (assuming legal program)
-          numHints += stackSize / 2;
-        }
-        tokSize = 1 + numHints / 8 + ((numHints % 8 != 0) ? 1 : 0);
-      } else if (first < 28) {
-        // operators 21-27
-        if (first == 23) {
-          // vstemhm
-          numHints += stackSize / 2;
-        }
-        tokSize = 1;
-      } else {
-        // operators 29-31
-        tokSize = 1;
-      }
+void charstring_pool_t::addRawCharstrings(unsigned char* data,
+                                          const uint32_t* csOffsets,
+                                          unsigned n) {
+  /// adds the n charstrings [csOffsets[i], csOffsets[i + 1]) of data,
+  /// tokenizing them on numThreads threads
 
-      stackSize = 0;
-    } else {
-      stackSize += 1;
+  assert(!finalized);
 
-      if (first == 28) {
-        // 16-bit signed
-        tokSize = 3;
-      } else if (first < 247) {
-        // -107 to 107
-        tokSize = 1;
-      } else if (first < 251) {
-        // +108 to +1131
-        tokSize = 2;
-      } else if (first < 255) {
-        // -108 to -1131
-        tokSize = 2;
+  thread_pool_t& threads = getThreads();
+  unsigned nParts = std::min(threads.size(), n);
+  if (nParts <= 1) {
+    for (unsigned i = 0; i < n; ++i)
+      addRawCharstring(data + csOffsets[i], csOffsets[i + 1] - csOffsets[i]);
+    return;
+  }
+
+  // Each part is a run of glyphs of about the same number of bytes,
+  // tokenized with quarks of its own. Merging the parts in order then
+  // numbers the quarks just as adding the glyphs one by one would.
+  std::vector<unsigned> bounds(nParts + 1, n);
+  bounds[0] = 0;
+  uint64_t totalLen = csOffsets[n] - csOffsets[0];
+  unsigned glyph = 0;
+  for (unsigned part = 1; part < nParts; ++part) {
+    uint64_t target = csOffsets[0] + totalLen * part / nParts;
+    while (glyph < n && csOffsets[glyph] < target)
+      ++glyph;
+    bounds[part] = glyph;
+  }
+
+  std::vector<std::vector<token_t> > partTokens(nParts);
+  std::vector<std::vector<unsigned> > partCounts(nParts);
+  std::vector<quark_table_t> partQuarks(nParts);
+  std::vector<std::function<void()> > tasks;
+  for (unsigned part = 0; part < nParts; ++part) {
+    tasks.push_back([&, part]() {
+      for (unsigned i = bounds[part]; i < bounds[part + 1]; ++i) {
+        partCounts[part].push_back(tokenizeCharstring(
+                                        data + csOffsets[i],
+                                        csOffsets[i + 1] - csOffsets[i],
+                                        partQuarks[part],
+                                        partTokens[part]));
+      }
+    });
+  }
+  threads.run(tasks);
+
+  size_t nToks = pool.size();
+  for (const std::vector<token_t>& tokens : partTokens)
+    nToks += tokens.size();
+  pool.reserve(nToks);
+
+  for (unsigned part = 0; part < nParts; ++part) {
+    const quark_table_t& local = partQuarks[part];
+    std::vector<uint16_t> globalQuark(local.size());
+    for (unsigned q = 0; q < local.size(); ++q)
+      globalQuark[q] = quarks.quarkFor(local.begin(q),
+                                       local.end(q) - local.begin(q));
+
+    for (const token_t& tok : partTokens[part]) {
+      if (tok.size() < int_size) {
+        pool.push_back(tok);
       } else {
-        // 4-byte floating point
-        tokSize = 5;
+        int_type v = tok.getValue();
+        pool.push_back(token_t((v & 0xffff0000) | globalQuark[v & 0xffff]));
       }
     }
-
-    unsigned char rawTok[tokSize];
-    rawTok[0] = first;
-    memcpy(rawTok + 1, data + csPos + 1, tokSize - 1);
-    csPos += (tokSize - 1);
-
-    addRawToken(rawTok, tokSize);
-
-    ++nToks;
+    for (unsigned partToks : partCounts[part])
+      offset.push_back(offset.back() + partToks);
   }
-
-  offset.push_back(offset.back() + nToks);
 }
 
 void charstring_pool_t::setFDSelect(uint8_t* rawFD) {
@@ -751,6 +1285,41 @@ void charstring_pool_t::setFDSelect(uint8_t* rawFD) {
   }
 }
 
+void charstring_pool_t::setMaxSubrLength(unsigned maxLen) {
+  // 0 means no limit
+  maxSubrLength = maxLen;
+}
+
+void charstring_pool_t::setConvergence(float threshold) {
+  // 0 means always run numRounds rounds
+  convergence = threshold;
+}
+
+void charstring_pool_t::setVerbose(bool _verbose) {
+  verbose = _verbose;
+}
+
+void charstring_pool_t::setSuffixSort(suffix_sort_t sort) {
+  suffixSort = sort;
+}
+
+void charstring_pool_t::setNumThreads(unsigned nThreads) {
+  // 0 means the default, 1 runs everything on the calling thread
+  numThreads = nThreads > 0 ? nThreads : defaultNumThreads();
+  threadPool.reset();
+}
+
+thread_pool_t& charstring_pool_t::getThreads() {
+  // started on first use, then shared by tokenizing and every round
+  if (!threadPool)
+    threadPool.reset(new thread_pool_t(numThreads));
+  return *threadPool;
+}
+
+int charstring_pool_t::getRoundsRun() const {
+  return roundsRun;
+}
+
 void charstring_pool_t::finalize() {
   rev.reserve(pool.size());
   int cur = 0;
@@ -768,50 +1337,6 @@ const_tokiter_t charstring_pool_t::get(unsigned idx) const {
   return x;
 }
 
-inline uint16_t charstring_pool_t::quarkFor(unsigned char* data, unsigned len) {
-  // TODO: verify using a string key isn't a time problem
-  std::string key((const char*) data, (size_t) len);
-  auto it = quarkMap.find(key);
-  if (it == quarkMap.end()) {
-    assert(nextQuark < 65536);
-    assert(revQuark.size() == nextQuark);
-    unsigned q = nextQuark++;
-    quarkMap[key] = q;
-    revQuark.push_back(key);
-    return (uint16_t) q;
-  } else {
-    return (uint16_t) it->second;
-  }
-}
-
-void charstring_pool_t::addRawToken(unsigned char* data, unsigned len) {
-  assert(len > 0);
-  assert(len < 256);
-  int_type v = generateValue(data, len);
-  pool.push_back(token_t(v));
-}
-
-int_type charstring_pool_t::generateValue(unsigned char* data, unsigned len) {
-  int_type v;
-  if (len < int_size) {
-    v = len;
-    for (unsigned i = 0; i < len; ++i) {
-      v <<= 8;
-      v |= data[i];
-    }
-    v <<= 8 * (int_size - len - 1);
-  } else {
-    uint16_t q = quarkFor(data, len);
-    v = len;
-    v <<= 8;
-    v |= data[0];
-    v <<= 16;
-    v |= q;
-    // std::cout << "QUARK: " << q << std::endl;
-  }
-  return v;
-}
-
 struct charstring_pool_t::suffixSortFunctor {
   const std::vector<token_t> &pool;
   const std::vector<unsigned> &offset;
@@ -847,6 +1372,9 @@ struct charstring_pool_t::suffixSortFunctor {
 std::vector<unsigned> charstring_pool_t::generateSuffixes() {
   assert(finalized);
 
+  if (suffixSort == SUFFIX_SORT_SAIS)
+    return generateSuffixesSAIS();
+
   std::vector<unsigned> suffixes;
   suffixes.reserve(pool.size());
 
@@ -861,6 +1389,55 @@ std::vector<unsigned> charstring_pool_t::generateSuffixes() {
   return suffixes;
 }
 
+std::vector<unsigned> charstring_pool_t::generateSuffixesSAIS() {
+  /// the same order as the comparison sort: each charstring ends in its
+  /// own sentinel, below every token and ordered by glyph, so suffixes
+  /// never run into the next charstring, a prefix sorts first and equal
+  /// suffixes stay in pool order
+
+  std::vector<int_type> values;
+  values.reserve(pool.size());
+  for (const token_t& tok : pool)
+    values.push_back(tok.getValue());
+  std::sort(values.begin(), values.end());
+  values.erase(std::unique(values.begin(), values.end()), values.end());
+
+  // 0 ends the text, 1..count are the sentinels, then the tokens
+  uint32_t n = pool.size() + count + 1;
+  std::vector<uint32_t> text;
+  text.reserve(n);
+  for (unsigned i = 0; i < count; ++i) {
+    for (unsigned pos = offset[i]; pos < offset[i + 1]; ++pos) {
+      uint32_t rank = std::lower_bound(values.begin(), values.end(),
+                                       pool[pos].getValue()) - values.begin();
+      text.push_back(count + 1 + rank);
+    }
+    text.push_back(i + 1);
+  }
+  text.push_back(0);
+
+  std::vector<uint32_t> sa(n);
+  buildSuffixArray(text.data(), sa.data(), n, count + 1 + values.size());
+
+  // text is done with, so map its positions back into the pool
+  unsigned textPos = 0;
+  for (unsigned i = 0; i < count; ++i) {
+    for (unsigned pos = offset[i]; pos < offset[i + 1]; ++pos)
+      text[textPos++] = pos;
+    text[textPos++] = SA_EMPTY;
+  }
+  text[textPos] = SA_EMPTY;
+
+  std::vector<unsigned> suffixes;
+  suffixes.reserve(pool.size());
+  for (uint32_t textIdx : sa) {
+    if (text[textIdx] != SA_EMPTY)
+      suffixes.push_back(text[textIdx]);
+  }
+
+  return suffixes;
+}
+
 std::vector<unsigned> charstring_pool_t::generateLCP(
                               const std::vector<unsigned> &suffixes) {
   assert(finalized);
@@ -918,34 +1495,49 @@ bool charstring_pool_t::verify_lcp(
   return true;
 }
 
-std::list<substring_t> charstring_pool_t::generateSubstrings(
+substring_table_t charstring_pool_t::generateSubstrings(
                               std::vector<unsigned> &suffixes,
                               std::vector<unsigned> &lcp) {
   assert(finalized);
   assert(suffixes.size() == lcp.size());
   assert(lcp.size() == pool.size());
 
-  std::list<substring_t> substrings;
+  substring_table_t substrings;
   std::list<std::pair<unsigned, unsigned>> startIndices;
+  // where each LCP interval on the stack truly starts; startIndices
+  // keeps the start the frequency estimate has always been based on
+  std::vector<unsigned> intervalStarts;
+  occurrences.clear();
+  occurrenceOffsets.assign(1, 0);
 
   for (unsigned i = 0; i < suffixes.size(); ++i) {
+    unsigned intervalStart = i - 1;
     while (!startIndices.empty() && startIndices.back().first > lcp[i]) {
       unsigned len = startIndices.back().first;
       unsigned startIdx = startIndices.back().second;
       startIndices.pop_back();
+      intervalStart = intervalStarts.back();
+      intervalStarts.pop_back();
 
       unsigned freq = i - startIdx;
       assert(freq >= 2);  // NOTE: python allows different min_freq
 
-      substring_t subr(len, suffixes[startIdx], freq);
+      substring_t subr(len, suffixes[startIdx]);
       // NOTE: python allows turning this check off --
-      if (len > 1 && subr.subrSaving(*this) > 0) {
-        substrings.push_back(subr);
+      if (len > 1 && (maxSubrLength == 0 || len <= maxSubrLength)
+          && subr.subrSaving(*this, freq) > 0) {
+        substrings.add(subr, freq);
+        // the LCP interval holds every occurrence of the substring
+        occurrences.insert(occurrences.end(),
+                           suffixes.begin() + intervalStart,
+                           suffixes.begin() + i);
+        occurrenceOffsets.push_back(occurrences.size());
       }
     }
 
     if (startIndices.empty() || lcp[i] > startIndices.back().first) {
       startIndices.push_back(std::make_pair(lcp[i], i - 1));
+      intervalStarts.push_back(intervalStart);
     }
   }
 
@@ -954,6 +1546,23 @@ std::list<substring_t> charstring_pool_t::generateSubstrings(
   return substrings;
 }
 
+std::vector<occurrence_t> charstring_pool_t::findOccurrences(
+                              const substring_table_t& substrings) {
+  /// where each substring occurs in the pool, as found by
+  /// generateSubstrings (substrings must be what it returned)
+
+  assert(occurrenceOffsets.size() == substrings.size() + 1);
+  std::vector<occurrence_t> occs;
+  occs.reserve(occurrences.size());
+  for (uint32_t id = 0; id < substrings.size(); ++id) {
+    for (unsigned k = occurrenceOffsets[id]; k < occurrenceOffsets[id + 1];
+            ++k) {
+      occs.push_back(occurrence_t(occurrences[k], id));
+    }
+  }
+  return occs;
+}
+
 std::vector<unsigned char> charstring_pool_t::translateToken(const token_t& tok) const {
   size_t tokLen = tok.size();
 
@@ -964,8 +1573,8 @@ std::vector<unsigned char> charstring_pool_t::translateToken(const token_t& tok)
     return ans;
   } else {
     uint16_t q = (tok.part(2) << 8) + tok.part(3);
-    std::string orig = revQuark.at(q);
-    std::vector<unsigned char> ans(orig.begin(), orig.end());
+    assert(q < quarks.size());
+    std::vector<unsigned char> ans(quarks.begin(q), quarks.end(q));
     return ans;
   }
 }
@@ -975,7 +1584,8 @@ std::vector<unsigned char> charstring_pool_t::translateToken(const token_t& tok)
 
 charstring_pool_t CharstringPoolFactory(
                           std::istream &instream,
-                          int numRounds) {
+                          int numRounds,
+                          unsigned numThreads) {
   uint16_t count;
   unsigned char countBuffer[2];
   instream.read(reinterpret_cast<char*>(countBuffer), 2);
@@ -998,15 +1608,11 @@ charstring_pool_t CharstringPoolFactory(
   assert(offset[0] == 0);
 
   charstring_pool_t csPool(count, numRounds);
+  csPool.setNumThreads(numThreads);
 
-  unsigned len;
-  for (int i = 0; i < count; ++i) {
-    unsigned len = offset[i + 1] - offset[i];
-    char* data = new char[len];
-    instream.read(data, len);
-    csPool.addRawCharstring(reinterpret_cast<unsigned char*>(data), len);
-    delete[] data;
-  }
+  std::vector<unsigned char> data(offset[count]);
+  instream.read(reinterpret_cast<char*>(data.data()), data.size());
+  csPool.addRawCharstrings(data.data(), offset, count);
 
   unsigned char fdCount;
   instream.read(reinterpret_cast<char*>(&fdCount), 1);
@@ -1043,7 +1649,8 @@ void charstring_pool_t::printSuffix(unsigned idx, bool printVal) {
 
 charstring_pool_t CharstringPoolFactoryFromString(
                           unsigned char* buffer,
-                          int numRounds) {
+                          int numRounds,
+                          unsigned numThreads) {
   unsigned pos = 0;
 
   uint16_t count;
@@ -1066,13 +1673,10 @@ charstring_pool_t CharstringPoolFactoryFromString(
   assert(offset[0] == 0);
 
   charstring_pool_t csPool(count, numRounds);
+  csPool.setNumThreads(numThreads);
 
-  unsigned len;
-  for (int i = 0; i < count; ++i) {
-    unsigned len = offset[i + 1] - offset[i];
-    csPool.addRawCharstring(buffer + pos, len);
-    pos += len;
-  }
+  csPool.addRawCharstrings(buffer + pos, offset, count);
+  pos += offset[count];
 
   unsigned char fdCount = buffer[pos++];
   if (fdCount > 1) {
@@ -1088,10 +1692,18 @@ charstring_pool_t CharstringPoolFactoryFromString(
   return csPool;
 }
 
-extern "C" uint32_t* compreff(unsigned char* dataStream, int numRounds) {
-  charstring_pool_t csPool = CharstringPoolFactoryFromString(dataStream,
-                                                             numRounds);
-  std::list<substring_t> subrs = csPool.getSubstrings();
+extern "C" uint32_t* compreff(unsigned char* dataStream, int numRounds,
+                              float convergence, int numThreads,
+                              unsigned maxSubrLength, int suffixSort) {
+  // a negative count from the caller means the default, like 0
+  charstring_pool_t csPool = CharstringPoolFactoryFromString(
+                                    dataStream,
+                                    numRounds,
+                                    numThreads > 0 ? numThreads : 0);
+  csPool.setMaxSubrLength(maxSubrLength);
+  csPool.setConvergence(convergence);
+  csPool.setSuffixSort(static_cast<suffix_sort_t>(suffixSort));
+  substring_table_t subrs = csPool.getSubstrings();
   std::vector<encoding_list> glyphEncodings;
   csPool.subroutinize(subrs, glyphEncodings);
   return csPool.getResponse(subrs, glyphEncodings);
@@ -1103,12 +1715,46 @@ extern "C" void unload(char* response) {
 
 int main(int argc, const char* argv[]) {
   int numRounds = DEFAULT_NUM_ROUNDS;
+  unsigned maxSubrLength = 0;
+  float convergence = 0;
+  bool verbose = false;
+  suffix_sort_t suffixSort = SUFFIX_SORT_SAIS;
+  unsigned numThreads = 0;
 
   unsigned argIdx = 1;
   while (argIdx < static_cast<unsigned>(argc)) {
     if (strcmp(argv[argIdx], "--nrounds") == 0) {
       numRounds = atoi(argv[argIdx + 1]);
       argIdx += 2;
+    } else if (strcmp(argv[argIdx], "--maxlength") == 0) {
+      maxSubrLength = atoi(argv[argIdx + 1]);
+      argIdx += 2;
+    } else if (strcmp(argv[argIdx], "--verbose") == 0) {
+      verbose = true;
+      argIdx += 1;
+    } else if (strcmp(argv[argIdx], "--convergence") == 0) {
+      convergence = atof(argv[argIdx + 1]);
+      argIdx += 2;
+    } else if (strcmp(argv[argIdx], "--threads") == 0) {
+      int threadsArg = atoi(argv[argIdx + 1]);
+      if (threadsArg < 0) {
+        std::cerr << "Invalid thread count: " << argv[argIdx + 1]
+                  << std::endl;
+        return 1;
+      }
+      numThreads = threadsArg;
+      argIdx += 2;
+    } else if (strcmp(argv[argIdx], "--suffixsort") == 0) {
+      if (strcmp(argv[argIdx + 1], "sais") == 0) {
+        suffixSort = SUFFIX_SORT_SAIS;
+      } else if (strcmp(argv[argIdx + 1], "compare") == 0) {
+        suffixSort = SUFFIX_SORT_COMPARE;
+      } else {
+        std::cerr << "Unrecognized suffix sort: " << argv[argIdx + 1]
+                  << std::endl;
+        return 1;
+      }
+      argIdx += 2;
     } else {
       std::cerr << "Unrecognized argument: " << argv[argIdx] << std::endl;
       return 1;
@@ -1117,9 +1763,14 @@ int main(int argc, const char* argv[]) {
 
   charstring_pool_t csPool = CharstringPoolFactory(
                                       std::cin,
-                                      numRounds);
-
-  std::list<substring_t> subrs = csPool.getSubstrings();
+                                      numRounds,
+                                      numThreads);
+  csPool.setMaxSubrLength(maxSubrLength);
+  csPool.setConvergence(convergence);
+  csPool.setVerbose(verbose);
+  csPool.setSuffixSort(suffixSort);
+
+  substring_table_t subrs = csPool.getSubstrings();
   std::vector<encoding_list> glyphEncodings;
   csPool.subroutinize(subrs, glyphEncodings);
 
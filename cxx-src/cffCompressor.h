@@ -18,17 +18,23 @@
 #define CFFCOMPRESSOR_H_
 
 #include <assert.h>
+#include <chrono>
+#include <condition_variable>
 #include <forward_list>
 #include <future>
+#include <mutex>
 #include <stdint.h>
 #include <string.h>
 #include <thread>
 
 #include <algorithm>
+#include <cmath>
 #include <fstream>
+#include <functional>
 #include <iostream>
 #include <list>
 #include <map>
+#include <memory>
 #include <sstream>
 #include <stdexcept>
 #include <string>
@@ -39,10 +45,10 @@
 class token_t;
 struct charstring_t;
 class substring_t;
+class substring_table_t;
 class charstring_pool_t;
 
 typedef uint32_t int_type;
-typedef std::map<std::string, unsigned> tokmap_t;
 typedef std::vector<token_t>::iterator tokiter_t;
 typedef std::vector<token_t>::const_iterator const_tokiter_t;
 
@@ -62,6 +68,36 @@ class token_t {
     int_type value;
 };
 
+// Numbers the raw bytes of the tokens too long to pack into a token_t
+// (hintmasks, reals) in the order they are first seen. The bytes are
+// kept back to back in one buffer, and found through a flat
+// open-addressing table keyed by their hash.
+class quark_table_t {
+  public:
+    quark_table_t();
+    unsigned size() const { return hashes.size(); }
+    uint16_t quarkFor(const unsigned char* data, unsigned len);
+    const unsigned char* begin(uint16_t q) const {
+      return bytes.data() + starts[q];
+    }
+    const unsigned char* end(uint16_t q) const {
+      return bytes.data() + starts[q + 1];
+    }
+
+  private:
+    std::vector<unsigned char> bytes;
+    std::vector<uint32_t> starts;
+    std::vector<uint64_t> hashes;
+    std::vector<uint32_t> slots;  // quark + 1, or 0 if empty
+    unsigned shift;
+
+    void insert(uint16_t q);
+};
+
+unsigned tokenizeCharstring(const unsigned char* data, unsigned len,
+                            quark_table_t& quarks,
+                            std::vector<token_t>& tokens);
+
 typedef struct charstring_t {
   tokiter_t begin;
   uint32_t len;
@@ -86,21 +122,21 @@ class light_substring_t {
 
 typedef struct encoding_item {
   uint32_t pos;
-  substring_t* substr;
+  uint32_t substr;  // id in the substring_table_t
 } encoding_item;
 
 typedef std::vector<encoding_item> encoding_list;
 
 class substring_t {
   public:
-    substring_t(unsigned _len, unsigned _start, unsigned _freq);
+    substring_t(unsigned _len, unsigned _start);
     substring_t(const substring_t &other);
     const_tokiter_t begin(const charstring_pool_t &chPool) const;
     const_tokiter_t end(const charstring_pool_t &chPool) const;
     uint16_t cost(const charstring_pool_t &chPool);
-    int subrSaving(const charstring_pool_t &chPool);
+    int subrSaving(const charstring_pool_t &chPool, unsigned freq);
     uint16_t cost(const charstring_pool_t &chPool) const;
-    int subrSaving(const charstring_pool_t &chPool) const;
+    int subrSaving(const charstring_pool_t &chPool, unsigned freq) const;
     std::string toString(const charstring_pool_t &chPool);
     bool operator<(const substring_t &other) const;
     bool operator==(const substring_t &other) const;
@@ -108,16 +144,6 @@ class substring_t {
     substring_t& operator=(const substring_t &other);
     inline uint32_t size() const;
     inline uint32_t getStart() const;
-    void updatePrice();
-    uint32_t getFreq() const;
-    void resetFreq();
-    void incrementFreq();
-    void increaseFreq(unsigned amt);
-    void decrementFreq();
-    float getPrice() const;
-    void setPrice(float newPrice);
-    void setAdjCost(float value);
-    void syncPrice();
     std::vector<unsigned char> getTranslatedValue(
             const charstring_pool_t& chPool) const;
 
@@ -128,58 +154,173 @@ class substring_t {
   private:
     uint32_t start;
     uint32_t len;
-    uint32_t freq;
     uint16_t _cost;
-    float adjCost;
-    float price;
 
-    int doSubrSaving(int subCost) const;
+    int doSubrSaving(int subCost, unsigned freq) const;
     uint16_t doCost(const charstring_pool_t &chPool) const;
 };
 
 typedef std::pair<std::vector<encoding_list>, std::vector<substring_t> >
         subr_pair;
 
+// The candidate substrings, addressed by their index (their id). The
+// fields the market updates every round are kept in arrays of their
+// own, indexed by id, rather than in the substrings.
+class substring_table_t {
+  public:
+    uint32_t size() const { return substrs.size(); }
+    bool empty() const { return substrs.empty(); }
+    substring_t& operator[](uint32_t id) { return substrs[id]; }
+    const substring_t& operator[](uint32_t id) const { return substrs[id]; }
+    void add(const substring_t &substr, uint32_t freq);
+    int subrSaving(uint32_t id, const charstring_pool_t &chPool);
+    void updatePrices();
+    std::vector<uint32_t> compact(const std::vector<bool> &keep);
+
+    std::vector<float> prices;
+    std::vector<float> adjCosts;
+    std::vector<uint32_t> freqs;
+
+  private:
+    std::vector<substring_t> substrs;
+};
+
+typedef std::pair<uint32_t, uint32_t> occurrence_t;
+
+// How generateSuffixes orders the suffixes of the pool: by SA-IS in
+// linear time, or by the original token-by-token comparison sort.
+enum suffix_sort_t { SUFFIX_SORT_SAIS, SUFFIX_SORT_COMPARE };
+
+// The candidate substrings that occur at each position of the pool,
+// shortest first, so that the DP only visits real matches.
+class occurrence_index_t {
+  public:
+    occurrence_index_t(uint32_t poolSize,
+                       std::vector<occurrence_t> &occurrences,
+                       const substring_table_t &substrings);
+    void remap(const std::vector<uint32_t> &newIds);
+    const uint32_t* begin(uint32_t pos) const {
+      return substrs.data() + offset[pos];
+    }
+    const uint32_t* end(uint32_t pos) const {
+      return substrs.data() + offset[pos + 1];
+    }
+
+  private:
+    std::vector<uint32_t> offset;
+    std::vector<uint32_t> substrs;
+};
+
+// Workers that live as long as the charstring pool, so a run starts its
+// threads once, for tokenizing and every market round. With one thread
+// (or none) the tasks run on the calling thread.
+class thread_pool_t {
+  public:
+    explicit thread_pool_t(unsigned nThreads);
+    ~thread_pool_t();
+    unsigned size() const;
+    void run(const std::vector<std::function<void()> > &tasks);
+
+  private:
+    std::vector<std::thread> workers;
+    std::mutex mutex;
+    std::condition_variable ready;
+    std::condition_variable done;
+    const std::vector<std::function<void()> >* tasks;
+    unsigned nextTask;
+    unsigned pending;
+    bool stopping;
+
+    void work();
+};
+
+unsigned defaultNumThreads();
+
+// Buffers a DP worker reuses across calls and rounds, so that
+// optimizeCharstring allocates nothing once they have grown. The
+// encodings of the glyphs a worker optimizes are laid end to end in
+// its arena.
+typedef struct dp_scratch_t {
+  std::vector<float> results;
+  std::vector<int> nextEncIdx;
+  std::vector<uint32_t> nextEncSubstr;
+  encoding_list arena;
+} dp_scratch_t;
+
+// Where a glyph's encoding lies: [begin, end) of a worker's arena.
+typedef struct encoding_span_t {
+  uint32_t arena;
+  uint32_t begin;
+  uint32_t end;
+} encoding_span_t;
+
+void buildSuffixArray(const uint32_t* text, uint32_t* sa, uint32_t n,
+                      uint32_t alphabetSize);
+
 void optimizeSubstrings(
-                    std::map<light_substring_t,
-                    substring_t*> &substrMap,
+                    const occurrence_index_t &index,
                     charstring_pool_t &csPool,
-                    std::list<substring_t>::iterator begin,
-                    std::list<substring_t>::iterator end);
+                    substring_table_t &substrings,
+                    const std::vector<uint32_t>& ids,
+                    unsigned maxLen,
+                    dp_scratch_t& scratch,
+                    double& busyTime);
 
-std::vector<encoding_list> optimizeGlyphstrings(
-                    std::map<light_substring_t,
-                    substring_t*> &substrMap,
+void optimizeGlyphstrings(
+                    const occurrence_index_t &index,
                     charstring_pool_t &csPool,
-                    unsigned start,
-                    unsigned stop);
+                    const substring_table_t &substrings,
+                    const std::vector<unsigned>& glyphs,
+                    unsigned maxLen,
+                    uint32_t arena,
+                    dp_scratch_t& scratch,
+                    std::vector<encoding_span_t>& glyphSpans,
+                    std::vector<float>& glyphCosts,
+                    double& busyTime);
 
-std::pair<encoding_list, float> optimizeCharstring(
+uint64_t estimateDPCost(unsigned len, unsigned maxLen);
+
+std::vector<std::vector<unsigned> > partitionWork(
+                    const std::vector<uint64_t>& costs,
+                    unsigned nParts);
+
+float optimizeCharstring(
                     const_tokiter_t begin,
                     uint32_t len,
-                    std::map<light_substring_t, substring_t*> &substrMap,
+                    const occurrence_index_t &index,
+                    const substring_table_t &substrings,
                     charstring_pool_t& csPool,
-                    bool isSubstring);
+                    unsigned maxLen,
+                    dp_scratch_t& scratch,
+                    encoding_list& encoding);
 
 class charstring_pool_t {
   public:
     explicit charstring_pool_t(unsigned nCharstrings);
     charstring_pool_t(unsigned nCharstrings, int numRounds);
     void writeSubrs(
-                std::list<substring_t>& substrings,
+                substring_table_t& substrings,
                 std::vector<encoding_list>& glyphEncodings,
                 std::ostream& outFile);
     uint32_t* getResponse(
-                std::list<substring_t>& substrings,
+                substring_table_t& substrings,
                 std::vector<encoding_list>& glyphEncodings);
     std::vector<unsigned char> formatInt(int num);
     void subroutinize(
-                std::list<substring_t>& substrings,
+                substring_table_t& substrings,
                 std::vector<encoding_list>& glyphEncodings);
-    std::list<substring_t> getSubstrings();
+    substring_table_t getSubstrings();
     charstring_t getCharstring(unsigned idx);
     void addRawCharstring(unsigned char* data, unsigned len);
+    void addRawCharstrings(unsigned char* data, const uint32_t* csOffsets,
+                           unsigned n);
     void setFDSelect(uint8_t* rawFD);
+    void setMaxSubrLength(unsigned maxLen);
+    void setConvergence(float threshold);
+    void setVerbose(bool verbose);
+    void setSuffixSort(suffix_sort_t sort);
+    void setNumThreads(unsigned nThreads);
+    int getRoundsRun() const;
     void finalize();
     const_tokiter_t get(unsigned idx) const;
     std::vector<unsigned char> translateToken(const token_t& tok) const;
@@ -188,47 +329,60 @@ class charstring_pool_t {
     bool verify_lcp(std::vector<unsigned>& lcp, std::vector<unsigned>& suffixes);
 
   private:
-    tokmap_t quarkMap;
-    unsigned nextQuark;
-    std::vector<std::string> revQuark;
+    quark_table_t quarks;
     std::vector<token_t> pool;
     std::vector<unsigned> offset;
     std::vector<uint8_t> fdSelect;
     std::vector<unsigned> rev;
+    std::vector<uint32_t> occurrences;
+    std::vector<uint32_t> occurrenceOffsets;
     bool fdSelectTrivial;
     unsigned count;
     bool finalized;
     int numRounds;
+    unsigned maxSubrLength;
+    float convergence;
+    int roundsRun;
+    bool verbose;
+    suffix_sort_t suffixSort;
+    unsigned numThreads;
+    std::unique_ptr<thread_pool_t> threadPool;
+    // time spent optimizing in each partition of the work, over all rounds
+    std::vector<double> busyTimes;
+
+    thread_pool_t& getThreads();
 
-    inline uint16_t quarkFor(unsigned char* data, unsigned len);
-    void addRawToken(unsigned char* data, unsigned len);
-    int_type generateValue(unsigned char* data, unsigned len);
     std::vector<unsigned> generateSuffixes();
+    std::vector<unsigned> generateSuffixesSAIS();
     struct suffixSortFunctor;
     std::vector<unsigned> generateLCP(const std::vector<unsigned>& suffixes);
-    std::list<substring_t> generateSubstrings(
+    substring_table_t generateSubstrings(
                                         std::vector<unsigned> &suffixes,
                                         std::vector<unsigned> &lcp);
-    encoding_list getUpdatedEncoding(substring_t* subr);
-    void writeEncoding(
-              const encoding_list& enc,
-              const std::map<const substring_t*, uint32_t>& index,
-              std::ostream& outFile);
-    unsigned packEncoding(
-              const encoding_list& enc,
-              const std::map<const substring_t*, uint32_t>& index,
-              uint32_t* buffer);
+    std::vector<occurrence_t> findOccurrences(
+                                  const substring_table_t& substrings);
+    void writeEncoding(const encoding_list& enc, std::ostream& outFile);
+    unsigned packEncoding(const encoding_list& enc, uint32_t* buffer);
 };
 
 charstring_pool_t CharstringPoolFactory(
                         std::istream& instream,
-                        int numRounds);
+                        int numRounds,
+                        unsigned numThreads);
 
 charstring_pool_t CharstringPoolFactoryFromString(
                         unsigned char* buffer,
-                        int numRounds);
+                        int numRounds,
+                        unsigned numThreads);
+
+bool marketConverged(float lastCost, float cost,
+                     const std::vector<uint32_t>& lastUsages,
+                     const std::vector<uint32_t>& usages,
+                     float threshold);
 
-extern "C" uint32_t* compreff(unsigned char* dataStream, int numRounds);
+extern "C" uint32_t* compreff(unsigned char* dataStream, int numRounds,
+                              float convergence, int numThreads,
+                              unsigned maxSubrLength, int suffixSort);
 extern "C" void unload(char* response);
 
 #endif